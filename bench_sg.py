@@ -0,0 +1,266 @@
+import argparse, contextlib, io, json, os, platform, random, sys, tempfile, time, tracemalloc
+import numpy as np
+from sg_functions import *
+from quote_to_morse import string_to_morse_tones, render_morse, write_morse
+from sg_drums import render_pattern
+from mus_from_nums import numbers_to_notes, sonify_file
+from image_to_sound import px_array_to_hexval, px_array_to_brightness, ns_dur as img_ns_dur
+
+# benchmarks for the synthesis hot paths and the three generation pipelines
+#
+#   python bench_sg.py                                   run everything, save bench_results.json
+#   python bench_sg.py --quick --filter generate_signals
+#   python bench_sg.py --baseline old.json --threshold 0.25
+#
+# every case reports the best wall time over --repeat runs, the throughput in samples (or
+# items) per second and the peak memory traced during one extra run. Comparing against a
+# baseline exits with status 1 if any case got slower or bigger by more than the threshold.
+
+A_MAJ = [440.00, 493.88, 523.25, 587.33, 659.25, 739.99, 783.99]
+QUOTE = "the opposite of poverty is not wealth; the opposite of poverty is enough"
+
+def random_notes(num_notes:int, duration:float, seed:int=0):
+    rng = random.Random(seed)
+    return [[rng.choice(A_MAJ) / 4, duration] for i in range(num_notes)]
+
+def random_image(height:int, width:int, seed:int=0):
+    return np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+def bench_cases(quick:bool):
+    """
+    Every case as (name, setup) where setup() returns (function, units, unit_name).
+    Setup work (building inputs) is not timed.
+    """
+    note_counts = [50, 500] if quick else [50, 500, 5000]
+    durations = [0.075, 0.3]
+    ks = [8, 32]
+    srs = [22050, 44100]
+    cases = []
+
+    for n in note_counts:
+        for dur in durations:
+            for k in ks:
+                for sr in srs:
+                    def setup(n=n, dur=dur, k=k, sr=sr):
+                        notes = random_notes(n, dur)
+                        samples = sum(ADSR_length(note[1], 0.05, sr) for note in notes)
+                        return (lambda: generate_signals(notes, k=k, amp=0.7, sr=sr)), samples, "samples"
+                    cases.append(("generate_signals/notes={}/dur={}/k={}/sr={}".format(n, dur, k, sr), setup))
+
+    # float32 against float64 for the same stream, peak_mb shows the memory halving
+    for n in note_counts:
+        for dtype in ["float64", "float32"]:
+            def setup(n=n, dtype=dtype):
+                notes = random_notes(n, 0.3)
+                samples = 3 * sum(ADSR_length(note[1], 0.05, SAMPLE_RATE) for note in notes)
+                return (lambda: render_voices(notes, amp=0.7, dtype=dtype)), samples, "samples"
+            cases.append(("render_voices/notes={}/dtype={}".format(n, dtype), setup))
+
+    # one (samples, voices) array or stereo mix against the three separate buffers above
+    for n in note_counts:
+        for layout in ["multi", "stereo"]:
+            def setup(n=n, layout=layout):
+                notes = random_notes(n, 0.3)
+                samples = 3 * sum(ADSR_length(note[1], 0.05, SAMPLE_RATE) for note in notes)
+                pan = default_pans(("hrm", "sin", "tri")) if layout == "stereo" else None
+                return (lambda: render_channels(notes, pan=pan, amp=0.7)), samples, "samples"
+            cases.append(("render_channels/notes={}/{}".format(n, layout), setup))
+
+    for dur in [0.1, 1.0, 10.0]:
+        for sr in srs:
+            def setup(dur=dur, sr=sr):
+                return (lambda: build_ADSR_envelope(dur, sr=sr)), ADSR_length(dur, 0.05, sr), "samples"
+            cases.append(("generate_ADSR_envelope/dur={}/sr={}".format(dur, sr), setup))
+
+    for note_num in [45, 69, 79]:
+        for num_sinusoids in [50, 1000]:
+            def setup(note_num=note_num, num_sinusoids=num_sinusoids):
+                return (lambda: generate_triangle(note_num, 1.0, 1.0, num_sinusoids, 44100)), 44100, "samples"
+            cases.append(("generate_triangle/note={}/num_sinusoids={}".format(note_num, num_sinusoids), setup))
+
+    for k in ks:
+        for dur in [0.1, 1.0]:
+            def setup(k=k, dur=dur):
+                return (lambda: k_harmonics(k, 1.0, 220.0, dur, 44100)), num_samples(dur, 44100), "samples"
+            cases.append(("k_harmonics/k={}/dur={}".format(k, dur), setup))
+
+    for n in [10_000, 1_000_000]:
+        def setup(n=n):
+            values = np.random.default_rng(0).integers(0, 1 << 24, n)
+            as_list = values.tolist()
+            return (lambda: lov_to_new_range(as_list, 0, 1 << 24, 0, 20)), n, "values"
+        cases.append(("lov_to_new_range/list/n={}".format(n), setup))
+        def setup(n=n):
+            values = np.random.default_rng(0).integers(0, 1 << 24, n)
+            return (lambda: lov_to_new_range(values, 0, 1 << 24, 0, 20)), n, "values"
+        cases.append(("lov_to_new_range/array/n={}".format(n), setup))
+
+    for n in note_counts:
+        for stream in [False, True]:
+            def setup(n=n, stream=stream):
+                notes = [(freq2midi(f), d) for f, d in random_notes(n, 0.1)]
+                path = os.path.join(tempfile.gettempdir(), "bench_sg.mid")
+                def run():
+                    with contextlib.redirect_stdout(io.StringIO()): # drop the "MIDI file saved" line
+                        create_midi_from_notes(notes, path, stream=stream)
+                return run, n, "notes"
+            cases.append(("create_midi_from_notes/notes={}".format(n) + ("/stream" if stream else ""), setup))
+
+    # the pipelines run end to end like the scripts: parse, notes, note list, MIDI file and the
+    # WAV export, streamed as with --no-plot or rendered whole as with the plot
+    for n in note_counts:
+        for stream in [True, False]:
+            def setup(n=n, stream=stream):
+                path = os.path.join(tempfile.gettempdir(), "bench_sg_input.txt")
+                with open(path, "w") as f:
+                    f.write(" ".join(str(i) for i in np.random.default_rng(0).integers(-1000, 1000, n)))
+                output_dir = os.path.join(tempfile.gettempdir(), "bench_sg_mus_from_nums")
+                samples = n * ADSR_length(0.075, 0.05, SAMPLE_RATE)
+                def run():
+                    with contextlib.redirect_stdout(io.StringIO()): # drop the "MIDI file saved" line
+                        return sonify_file(path, output_dir, n_amp=0.7, stream=stream)
+                return run, samples, "samples"
+            cases.append(("pipeline/mus_from_nums/notes={}".format(n) + ("" if stream else "/whole"), setup))
+
+    for repeats in [1, 10]:
+        def setup(repeats=repeats):
+            text = " ".join([QUOTE]*repeats)
+            samples = sum(ADSR_length(d, 0.01, SAMPLE_RATE) for f, d in string_to_morse_tones(text, 100, 554.36))
+            files = {v: os.path.join(tempfile.gettempdir(), "bench_sg_morse_{}.wav".format(v)) for v in ["hrm", "sin", "tri"]}
+            midi_file = os.path.join(tempfile.gettempdir(), "bench_sg_morse.mid")
+            def run():
+                notes = string_to_morse_tones(text, dit_len_ms=100, frequency=554.36)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    create_midi_from_notes([(freq2midi(f), d) for f, d in notes], midi_file)
+                return write_morse(text, files, dit_len_ms=100, frequency=554.36, amp=0.7, k=8, A=0.01, D=0.0, S=1.0, R=0.01, sr=SAMPLE_RATE)
+            return run, samples, "samples"
+        cases.append(("pipeline/quote_to_morse/repeats={}".format(repeats), setup))
+        def setup(repeats=repeats):
+            text = " ".join([QUOTE]*repeats)
+            samples = sum(ADSR_length(d, 0.01, SAMPLE_RATE) for f, d in string_to_morse_tones(text, 100, 554.36))
+            return (lambda: render_morse(text, dit_len_ms=100, frequency=554.36, amp=0.7, k=8, A=0.01, D=0.0, S=1.0, R=0.01)), samples, "samples"
+        cases.append(("pipeline/quote_to_morse/render_morse/repeats={}".format(repeats), setup))
+
+    for bars in [16, 1000]:
+        def setup(bars=bars):
+            pattern = {"kick": "x...x...x...x...", "snare": "....x..o....x..."}
+            samples = len(render_pattern(pattern, repeats=bars))
+            return (lambda: render_pattern(pattern, repeats=bars)), samples, "samples"
+        cases.append(("render_pattern/bars={}".format(bars), setup))
+
+    for sr_out in [22050, 48000]:
+        def setup(sr_out=sr_out):
+            signal = np.random.default_rng(0).uniform(-0.5, 0.5, 10 * SAMPLE_RATE)
+            def run():
+                r = PolyphaseResampler(SAMPLE_RATE, sr_out)
+                return len(r.process(signal)) + len(r.flush())
+            return run, len(signal), "samples"
+        cases.append(("PolyphaseResampler/sr_out={}".format(sr_out), setup))
+
+    for format in ["wav", "flac"]:
+        def setup(format=format):
+            signals = {v: np.random.default_rng(i).uniform(-0.5, 0.5, 10 * SAMPLE_RATE) for i, v in enumerate(["hrm", "sin", "tri"])}
+            files = {v: os.path.join(tempfile.gettempdir(), "bench_sg_{}.{}".format(v, format)) for v in signals}
+            return (lambda: export_signals(signals, files, SAMPLE_RATE, normalize=0.98)), 3 * 10 * SAMPLE_RATE, "samples"
+        cases.append(("export_signals/voices=3/{}".format(format), setup))
+
+    for width in [100, 580] if quick else [100, 580, 2000]:
+        def setup(width=width):
+            ns_options = [i/4 for i in A_MAJ] + [i/2 for i in A_MAJ] + A_MAJ
+            px_a = random_image(2, width)
+            def run():
+                hexval_a = px_array_to_hexval(px_a)
+                brightness_a = px_array_to_brightness(px_a)
+                h_min, h_max = int(hexval_a.min()), int(hexval_a.max())
+                b_min, b_max = int(brightness_a.min()), int(brightness_a.max())
+                total = 0
+                for row in range(len(px_a)):
+                    note_values = lov_to_new_range(hexval_a[row], h_min, h_max, 0, len(ns_options)-1)
+                    dur_values = lov_to_new_range(brightness_a[row], b_min, b_max, img_ns_dur[0], img_ns_dur[1])
+                    notes = ([ns_options[n], d/1000] for n, d in zip(note_values, dur_values))
+                    total += stream_to_wav(notes, {"hrm": os.path.join(tempfile.gettempdir(), "bench_sg_{}_hrm_rand.wav".format(row))}, amp=0.5)
+                return total
+            samples = run()
+            return run, samples, "samples"
+        cases.append(("pipeline/image_to_sound/rows=2/width={}".format(width), setup))
+
+    return cases
+
+def run_case(setup, repeat:int):
+    fn, units, unit_name = setup()
+    fn() # warm caches and imports so every timed run sees the same state
+
+    best = float("inf")
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "seconds": best,
+        "units": units,
+        "unit": unit_name,
+        "per_sec": units / best if best > 0 else float("inf"),
+        "peak_mb": peak / 2**20,
+    }
+
+def compare(results:dict, baseline:dict, threshold:float) -> list:
+    regressions = []
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        b = baseline[name]
+        for key in ["seconds", "peak_mb"]:
+            if b[key] > 0 and r[key] > b[key] * (1 + threshold):
+                regressions.append("{}: {} {:.4g} -> {:.4g} (+{:.0%})".format(name, key, b[key], r[key], r[key]/b[key] - 1))
+    return regressions
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description="benchmark the sound generation hot paths")
+    parser.add_argument("--quick", action="store_true", help="smaller grid of note counts and image sizes")
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case, the best is kept")
+    parser.add_argument("--output", default="bench_results.json", help="where to save the results")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown or memory growth, 0.25 = 25%%")
+    args = parser.parse_args()
+
+    results = {}
+    for name, setup in bench_cases(args.quick):
+        if args.filter not in name:
+            continue
+        r = run_case(setup, args.repeat)
+        results[name] = r
+        print("{:60s} {:9.4f} s {:12.4g} {}/s {:9.2f} MB".format(name, r["seconds"], r["per_sec"], r["unit"], r["peak_mb"]))
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "meta": {
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "machine": platform.machine(),
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            },
+            "results": results,
+        }, f, indent=2)
+    print("\nresults saved as {}".format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("\nregressions beyond {:.0%}:".format(args.threshold))
+            for r in regressions:
+                print("    " + r)
+            sys.exit(1)
+        print("\nno regressions beyond {:.0%} against {}".format(args.threshold, args.baseline))
+
+if __name__ == "__main__":
+    main()
@@ -1,60 +1,101 @@
 from PIL import Image
-import soundfile as sf
+import numpy as np
 from sg_functions import *
-import math, winsound, time
+from sg_realtime import beep # audible cues, skipped when there is no sound card
+from multiprocessing import Pool, shared_memory
+import argparse, time
 
 ns_dur = [50, 300] # note duration range
 output_dir = "data_img/"
 
-def RGB_to_HEXstr(R, G, B):
-    h_n = [math.floor(R/16), R%16, math.floor(G/16), G%16, math.floor(B/16), B%16]
-    h_h = [hex(i)[2:] for i in h_n]
-    h_s = ""
-    for i in h_h:
-        h_s += i
-    return "0x" + h_s
-
+# pixel data as an array of shape (height, width, 3), accessible as array[row][col]
 def image_to_px_array(image_name:str, format:str="jpg"):
     try:
-        img = Image.open(image_name + "." + format) # open image
-        px = list(img.getdata()) # get image pixel data
-        width, height = img.size # get image height and width in pixels
-
-        # accessible as array[row][col]
-        px_a = [px[i*width:(i+1)*width] for i in range(height)] # turn it into an array, with rows and columns y'know?
+        with Image.open(image_name + "." + format) as img: # open image
+            px_a = np.asarray(img.convert("RGB"))
     except:
         raise Exception("error analyzing image file")
 
     return px_a
 
+# the 0xRRGGBB value of every pixel at once
+def px_array_to_hexval(px_a):
+    px = px_a.astype(np.int64)
+    return (px[..., 0] << 16) | (px[..., 1] << 8) | px[..., 2]
+
+# R + G + B for every pixel at once
+def px_array_to_brightness(px_a):
+    return px_a.sum(axis=2, dtype=np.int64)
+
 # prints an array of tuples to a text file, input matches the output of "image_to_px_array"
 def aot_to_tf(array, file_name:str):
-    with open(file_name + ".txt", "w") as tf:
-        for row in array:
-            row_str = "["
-            for t in row:
-                row_str += "("
-                for i in t:
-                    row_str += "{0:3d},".format(i)
-                row_str = row_str[:-1]
-                row_str += "), "
-            row_str = row_str[:-2]
-            row_str += "]\n"
-            tf.write(row_str)
+    height, width, channels = array.shape
+    row_fmt = "[" + ", ".join(["(" + ",".join(["%3d"]*channels) + ")"]*width) + "]"
+    np.savetxt(file_name + ".txt", array.reshape(height, width*channels), fmt=row_fmt)
 
 # prints an array to a text file
 def a_to_tf(array, file_name:str):
-    with open(file_name + ".txt", "w") as tf:
-        for row in array:
-            row_str = "["
-            for t in row:
-                row_str += "{0:5d},".format(t)
-            row_str = row_str[:-2]
-            row_str += "]\n"
-            tf.write(row_str)
+    row_fmt = "[" + ",".join(["%5d"]*array.shape[1]) + "]"
+    np.savetxt(file_name + ".txt", array, fmt=row_fmt)
+
+DUMP_FORMATS = ["txt", "npy", "none"]
+
+# writes a debug matrix as text, as a .npy file (np.load(..., mmap_mode="r") maps it back), or not at all
+def dump_array(array, file_name:str, format:str="txt"):
+    if format == "txt":
+        if array.ndim == 3:
+            aot_to_tf(array, file_name)
+        else:
+            a_to_tf(array, file_name)
+    elif format == "npy":
+        np.save(file_name + ".npy", array)
+    elif format != "none":
+        raise Exception("unknown dump format '{}'".format(format))
+
+# state each row renderer needs, filled in by init_row_worker in every process
+row_state = {}
+
+def init_row_worker(hexval_shm, brightness_shm, shape, bounds, ns_options, export=None):
+    # worker processes attach to the parent's shared pixel data instead of receiving a pickled copy
+    for key, shm in (("hexval", hexval_shm), ("brightness", brightness_shm)):
+        if isinstance(shm, str):
+            shm = shared_memory.SharedMemory(name=shm)
+            row_state[key + "_shm"] = shm # keep the mapping alive as long as the worker
+        row_state[key] = np.ndarray(shape, dtype=np.int64, buffer=shm.buf)
+    row_state["bounds"] = bounds
+    row_state["ns_options"] = ns_options
+    row_state["export"] = export or {}
+
+def render_row(img_row:int):
+    pt_start = time.time()
+    h_min, h_max, b_min, b_max = row_state["bounds"]
+    ns_options = row_state["ns_options"]
+
+    note_values = lov_to_new_range(row_state["hexval"][img_row], h_min, h_max, 0, len(ns_options)-1)
+    dur_values = lov_to_new_range(row_state["brightness"][img_row], b_min, b_max, ns_dur[0], ns_dur[1])
+
+    # notes are produced as the renderer asks for them
+    ns_values = ([ns_options[n], d/1000] for n, d in zip(note_values, dur_values))
+
+    ################################## GEN SIGNAL + MAKE WAV FILES ##################################
+
+    # only the harmonic voice is written, add e.g. "sin": "_sin_rand.wav" here to render it too
+    wav_files = {"hrm": "_hrm_rand.wav"}
+
+    stream_to_wav(ns_values, {v: output_dir + str(img_row) + f for v, f in wav_files.items()}, amp=0.5, **row_state["export"])
+
+    return img_row, max(note_values), min(note_values), max(dur_values), min(dur_values), time.time() - pt_start
 
 def main() -> None:
 
+    parser = argparse.ArgumentParser(description="turn rows of an image into sound")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes rendering rows in parallel")
+    parser.add_argument("--dump", choices=DUMP_FORMATS, default="txt", help="format of the pixel, hex and brightness debug dumps")
+    add_export_args(parser, normalize=False)
+    add_profiling_args(parser)
+    args = parser.parse_args()
+    enable_profiling_from_args(args)
+
     print()
 
     start_time = time.time()
@@ -66,39 +107,31 @@ def main() -> None:
     ns_opt0 = [float(i/4) for i in ns_opt2]
     ns_options = ns_opt0 + ns_opt1 + ns_opt2
 
-    with Image.open("data_img/josie.jpg") as im:
-        # (left, upper, right, lower)
-        im_crop = im.crop((220, 700, 800, 720))
-        im_crop.save("data_img/josie_eyes.jpg")
+    with stage("parse"):
+        with Image.open("data_img/josie.jpg") as im:
+            # (left, upper, right, lower)
+            im_crop = im.crop((220, 700, 800, 720))
+            im_crop.save("data_img/josie_eyes.jpg")
 
-    px_a = image_to_px_array("data_img/josie_eyes") # turn image into an array of pixel colour data
+        px_a = image_to_px_array("data_img/josie_eyes") # turn image into an array of pixel colour data
 
-    hexval_a = []
-    for px_row in px_a:
-        hexval_row = []
-        for px in px_row:
-            hexval_row.append(int(RGB_to_HEXstr(px[0],px[1],px[2]), 16))
-        hexval_a.append(hexval_row)
-
-    brightness_a = []
-    for px_row in px_a:
-        brightness_row = []
-        for px in px_row:
-            brightness_row.append(int(px[0] + px[1] + px[2]))
-        brightness_a.append(brightness_row)
+    with stage("normalize", px_a.shape[0] * px_a.shape[1]):
+        hexval_a = px_array_to_hexval(px_a)
+        brightness_a = px_array_to_brightness(px_a)
 
     print("            pixel array: h={:4d}, w={:4d}".format(len(px_a), len(px_a[0])))
     print("hexadecimal value array: h={:4d}, w={:4d}".format(len(hexval_a), len(hexval_a[0])))
     print(" brightness value array: h={:4d}, w={:4d}".format(len(brightness_a), len(brightness_a[0])))
 
-    aot_to_tf(px_a, output_dir + "image_to_sound_px")
-    a_to_tf(hexval_a, output_dir + "image_to_sound_hex")
-    a_to_tf(brightness_a, output_dir + "image_to_sound_bri")
+    with stage("debug dumps"):
+        dump_array(px_a, output_dir + "image_to_sound_px", args.dump)
+        dump_array(hexval_a, output_dir + "image_to_sound_hex", args.dump)
+        dump_array(brightness_a, output_dir + "image_to_sound_bri", args.dump)
 
-    h_max = max([max(r) for r in hexval_a])
-    h_min = min([min(r) for r in hexval_a])
-    b_max = max([max(r) for r in brightness_a])
-    b_min = min([min(r) for r in brightness_a])
+    h_max = int(hexval_a.max())
+    h_min = int(hexval_a.min())
+    b_max = int(brightness_a.max())
+    b_min = int(brightness_a.min())
 
     print()
     print("hex: [{},{}]".format(h_min, h_max))
@@ -109,50 +142,43 @@ def main() -> None:
 
     print("\nbegin processing {} rows of image data.".format(len(px_a)))
 
-    winsound.Beep(440, 500)
+    beep(440, 500)
     sound_pt_start = time.time()
 
-    for img_row in range(len(px_a)):
-
-        note_values = lov_to_new_range(hexval_a[img_row], h_min, h_max, 0, len(ns_options)-1)
-        dur_values = lov_to_new_range(brightness_a[img_row], b_min, b_max, ns_dur[0], ns_dur[1])
-
-        print("\nbegin processing for row {}...".format(img_row))
-        print("    note index: max = {:3d}, min = {:3d}".format(max(note_values), min(note_values)))
-        print("duration value: max = {:3d}, min = {:3d}".format(max(dur_values), min(dur_values)))
-        pt_start = time.time()
-
-        ns_values = []
-        for i in range(len(note_values)):
-            ns_values.append([ns_options[note_values[i]], (dur_values[i])/1000])
-
-        ########################################## GEN SIGNAL ###########################################
+    hexval_shm = shared_memory.SharedMemory(create=True, size=hexval_a.nbytes)
+    brightness_shm = shared_memory.SharedMemory(create=True, size=brightness_a.nbytes)
+    np.ndarray(hexval_a.shape, dtype=np.int64, buffer=hexval_shm.buf)[:] = hexval_a
+    np.ndarray(brightness_a.shape, dtype=np.int64, buffer=brightness_shm.buf)[:] = brightness_a
+    bounds = (h_min, h_max, b_min, b_max)
+    export = export_options_from_args(args)
 
-        out = generate_signals(ns_values, amp=0.5)
-        hrm = out[0]
-        sin = out[1]
-        tri = out[2]
-
-        ######################################## MAKE WAV FILES #########################################
-
-        try:
-            sf.write(output_dir + str(img_row) + "_hrm_rand.wav", hrm, SAMPLE_RATE)
-        except:
-            sf.write(str(img_row) + "_hrm_rand.wav", hrm, SAMPLE_RATE)
-
-        # try:
-        #     sf.write(output_dir + str(img_row) + "_sin_rand.wav", sin, SAMPLE_RATE)
-        # except:
-        #     sf.write(str(img_row) + "_sin_rand.wav", sin, SAMPLE_RATE)
-
-        # try:
-        #     sf.write(output_dir + str(img_row) + "_tri_rand.wav", tri, SAMPLE_RATE)
-        # except:
-        #     sf.write(str(img_row) + "_tri_rand.wav", tri, SAMPLE_RATE)
-
-        winsound.Beep(220, 500)
-        t_p = time.time() - pt_start
-        print("processing time: {:0.2f} sec ({:0.2f} min)".format(t_p, t_p/60))
+    # with --workers the per-note stages run in the worker processes and only "rows" is recorded here
+    pool = None
+    try:
+        with stage("rows"):
+            if args.workers > 1:
+                # rows finish in any order but each one always writes {row}_hrm_rand.wav
+                pool = Pool(args.workers, initializer=init_row_worker,
+                            initargs=(hexval_shm.name, brightness_shm.name, hexval_a.shape, bounds, ns_options, export))
+                results = pool.imap_unordered(render_row, range(len(px_a)))
+            else:
+                init_row_worker(hexval_shm, brightness_shm, hexval_a.shape, bounds, ns_options, export)
+                results = map(render_row, range(len(px_a)))
+
+            for done, (img_row, n_max, n_min, d_max, d_min, t_p) in enumerate(results):
+                print("\nfinished row {} ({}/{})".format(img_row, done+1, len(px_a)))
+                print("    note index: max = {:3d}, min = {:3d}".format(n_max, n_min))
+                print("duration value: max = {:3d}, min = {:3d}".format(d_max, d_min))
+                print("processing time: {:0.2f} sec ({:0.2f} min)".format(t_p, t_p/60))
+                beep(220, 500)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        row_state.clear()
+        for shm in (hexval_shm, brightness_shm):
+            shm.close()
+            shm.unlink()
 
     t_p = time.time() - sound_pt_start
     print("\ntime to create sounds: {:0.2f} sec ({:0.2f} min)".format(t_p, t_p/60))
@@ -163,9 +189,11 @@ def main() -> None:
     for a in range(6):
         for i in range(3):
             for j in range(3):
-                winsound.Beep(220*(j+1), 100)
+                beep(220*(j+1), 100)
                 time.sleep(float(50)/1000)
         time.sleep(1)
 
+    print_profile_summary()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,66 @@
+import numpy as np
+from sg_functions import *
+import argparse, os, time
+
+DESCRIPTION = "render a MIDI file with the harmonic, sine and triangle voices"
+
+def render_midi_file(midi_file:str, files:dict, by_track:bool=False, block_size=BLOCK_SIZE, k=8, amp=1.0, sr=44100,
+                     A=0.04, D=0.06, S=0.6, R=0.05, dtype=np.float64, **options) -> int:
+    """
+    Stream a MIDI file to WAV files block by block.
+
+    files maps a voice name to the WAV file every note is rendered to with that voice. With
+    by_track there is only one output, files = {"mix": ...}, and each track plays with the
+    voice it is named after (hrm for any other track). options are passed on to write_blocks
+    (format, bits, sr_out, limit, dither). The file is read once and every note is rendered
+    with all the voices as it comes, so every output has the same length.
+
+    Returns:
+        Number of samples written per file
+    """
+    events = midi_file_events(midi_file)
+    if by_track:
+        blocks = ({"mix": block} for block in render_event_blocks(events, block_size, k=k, amp=amp, sr=sr, A=A, D=D, S=S, R=R, dtype=dtype))
+    else:
+        blocks = render_event_blocks(events, block_size, k=k, amp=amp, sr=sr, A=A, D=D, S=S, R=R, dtype=dtype, voices=tuple(files))
+    return write_blocks(blocks, files, sr, **options)
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("midi_file", help=".mid file to render, e.g. data_txt/midi_data.mid")
+    parser.add_argument("--output-dir", default="", help="where the audio files go (default next to the MIDI file)")
+    parser.add_argument("--voices", nargs="+", default=["hrm", "sin", "tri"], choices=sorted(VOICES), help="render every note with each of these voices, one file per voice")
+    parser.add_argument("--by-track", action="store_true", help="one mixed file, tracks named hrm/sin/tri play with that voice")
+    parser.add_argument("--amp", type=float, default=0.5, help="amplitude at MIDI velocity 127, overlapping notes add up")
+    parser.add_argument("--k", type=int, default=8, help="harmonics of the hrm voice")
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE, help="samples rendered at a time")
+    parser.add_argument("--dtype", choices=["float64", "float32"], default="float64", help="sample type used for synthesis")
+    add_export_args(parser, normalize=False)
+    add_profiling_args(parser)
+    args = parser.parse_args()
+    enable_profiling_from_args(args)
+
+    base = os.path.splitext(os.path.basename(args.midi_file))[0]
+    output_dir = os.path.join(args.output_dir or os.path.dirname(args.midi_file), "")
+    os.makedirs(output_dir, exist_ok=True)
+    if args.by_track:
+        files = {"mix": output_dir + base + "_mix.wav"}
+    else:
+        files = {v: output_dir + base + "_" + v + ".wav" for v in args.voices}
+    files = {v: export_file_name(f, args.format) for v, f in files.items()}
+
+    start = time.perf_counter()
+    written = render_midi_file(args.midi_file, files, args.by_track, args.block_size, k=args.k, amp=args.amp, sr=SAMPLE_RATE, dtype=args.dtype, **export_options_from_args(args))
+    elapsed = time.perf_counter() - start
+
+    seconds = written / SAMPLE_RATE
+    print("rendered {:0.2f} sec of audio to {} file(s) in {:0.2f} sec ({:0.1f}x realtime)".format(
+        seconds, len(files), elapsed, len(files) * seconds / elapsed if elapsed > 0 else float("inf")))
+    for file_name in files.values():
+        print("    " + file_name)
+
+    print_profile_summary()
+
+if __name__ == "__main__":
+    main()
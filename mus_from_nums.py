@@ -1,26 +1,17 @@
-import matplotlib.pyplot as plt
-import soundfile as sf
-import random
 from sg_functions import *
+from multiprocessing import Pool
+import argparse, glob, json, os, time
 
-def main() -> None:
-
-    ######################################## SET UP NOTE STREAM #########################################
-
-    #- specify info about note stream
-    n_amp = 0.7
-    n_k = 8
-    #ns_dur = [100, 100] # note duration range - see line 58
-    ns_dur = 75
+DESCRIPTION = "turn a file of integers into sound"
 
-    # A MAJ
-    # A4 (440 Hz), B4 (493.88 Hz), C5 (523.25 Hz), D5 (587.33 Hz), E5 (659.25 Hz), F#5 (739.99 Hz), G5 (783.99 Hz)
-    ns_options = [440, 493.88, 523.25, 587.33, 659.25, 739.99, 783.99]
+# A MAJ
+# A4 (440 Hz), B4 (493.88 Hz), C5 (523.25 Hz), D5 (587.33 Hz), E5 (659.25 Hz), F#5 (739.99 Hz), G5 (783.99 Hz)
+NS_OPTIONS = [n / 4 for n in [440, 493.88, 523.25, 587.33, 659.25, 739.99, 783.99]]
 
-    ns_options = [n / 4 for n in ns_options]
+# generate a list of pairs of notes and durations from a list of integers
+def numbers_to_notes(input_data:list[int], ns_options:list=NS_OPTIONS, ns_dur=75) -> list:
 
-    # parse text file - must be a bunch of integers separated by any whitespace
-    input_data = read_integers_from_file("data_txt/input.txt")
+    input_data = list(input_data)
 
     # normalize values
     minimum = min(input_data)
@@ -28,9 +19,8 @@ def main() -> None:
     for i, _ in enumerate(input_data):
         input_data[i] += minimum
 
-    normalized_input_data = lov_to_new_range(input_data, min(input_data), max(input_data), new_min=0, new_max=6)
+    normalized_input_data = lov_to_new_range(input_data, min(input_data), max(input_data), new_min=0, new_max=len(ns_options)-1)
 
-    # generate a list of pairs of notes and durations
     ns_values = []
     for i in normalized_input_data:
         frequency = ns_options[i]
@@ -38,74 +28,253 @@ def main() -> None:
         duration = ns_dur/1000
         ns_values.append([frequency, duration])
 
+    return ns_values
+
+def iter_numbers_to_notes(input_file:str, ns_options:list=NS_OPTIONS, ns_dur=75, bounds=None, chunk_bytes:int=INTEGER_CHUNK_BYTES):
+    """
+    numbers_to_notes for a file of integers, in bounded memory: the file is read in chunks
+    and mapped onto ns_options by iter_integers_to_new_range. bounds is the (min, max) of the
+    integers in the file, found by a first pass over it when None.
+
+    Yields:
+        The same [frequency, duration_seconds] pairs as numbers_to_notes on the whole file
+    """
+    duration = ns_dur/1000
+    for chunk in iter_integers_to_new_range(input_file, 0, len(ns_options)-1, bounds, chunk_bytes=chunk_bytes):
+        if len(chunk) > 0 and (chunk.min() < 0 or chunk.max() > len(ns_options)-1):
+            raise Exception("'{}' has integers outside the range {} to {}".format(input_file, *bounds))
+        for i in chunk.tolist():
+            yield [ns_options[i], duration]
+
+def sonify_file(input_file:str, output_dir:str="data_txt/", prefix:str="", n_amp=0.7, n_k=8, ns_dur=75, cache=None, dtype="float64", incremental=False, export=None, channels=None, stream=False, bounds=None):
+    """
+    Turn one file of integers into the note list, MIDI file and hrm/sin/tri WAV files.
+
+    Output files are written to output_dir with prefix in front of the usual names
+    (data.txt, midi_data.mid, hrm_txt.wav, ...), the three voices are written concurrently
+    by export_signals with the export options (format, bits, sr_out, limit, dither, normalize).
+    With incremental the WAV files from the previous run are updated through an
+    IncrementalRenderer, only the notes that changed since then are synthesized. With channels
+    (render_channels options, see channel_options_from_args) the voices are rendered into one
+    multichannel or stereo array and written as a single voices_txt.wav or stereo_txt.wav.
+    With stream the caller doesn't need the signals, so unless cache, incremental or normalize
+    need them whole they are rendered and written block by block (render_blocks, write_blocks)
+    and memory no longer grows with the length of the output: the notes are then read from
+    the file again for the note list, the MIDI file and the audio instead of being kept.
+    bounds is the (min, max) of the integers in the file, a first pass finds it when None.
+
+    Returns:
+        (manifest entry describing the outputs, rendered [hrm, sin, tri, notes], or one
+        signal per channel followed by the notes with channels, None with stream)
+    """
+    if incremental and channels is not None:
+        raise Exception("the incremental renderer writes a file per voice, it can't be used with channels")
+    start = time.perf_counter()
+    output_dir = os.path.join(output_dir, "") # make sure it ends in a separator
+    os.makedirs(output_dir, exist_ok=True)
+
+    ######################################## SET UP NOTE STREAM #########################################
+
+    export = export or {}
+    signals_needed = not stream
+    stream = stream and cache is None and not incremental and not export.get("normalize")
+
+    # parse text file - must be a bunch of integers separated by any whitespace
+    if bounds is None:
+        with stage("parse"):
+            bounds = integer_file_range(input_file)
+
+    # a streamed file is read again by everything that needs the notes, instead of keeping them
+    if stream:
+        note_stream = lambda: iter_numbers_to_notes(input_file, NS_OPTIONS, ns_dur, bounds)
+    else:
+        with stage("normalize") as st:
+            ns_values = list(iter_numbers_to_notes(input_file, NS_OPTIONS, ns_dur, bounds))
+            st.add_samples(len(ns_values))
+        note_stream = lambda: ns_values
+
     ######################################## GEN SIGNAL #########################################
 
+    outputs = {}
+    name = "voices" if channels is None or channels.get("pan") is None else "stereo" # of the one file with channels
+
     #print(ns_values)
-    out = generate_signals(ns_values, amp=n_amp, sr=SAMPLE_RATE, k=n_k)
-    hrm = out[0]
-    sin = out[1]
-    tri = out[2]
-    #print(out[3])
+    if stream:
+        with stage("synthesis") as st:
+            if channels is not None:
+                files = {name: output_dir + prefix + name + "_txt.wav"}
+                blocks = render_blocks(note_stream(), channels["voices"], k=n_k, amp=n_amp, sr=SAMPLE_RATE, dtype=dtype)
+                frames = ({name: block} for block in channel_blocks(blocks, **channels, dtype=dtype))
+                samples = write_blocks(frames, files, SAMPLE_RATE, channels=channel_count(**channels), **export)
+            else:
+                files = {v: output_dir + prefix + v + "_txt.wav" for v in ["hrm", "sin", "tri"]}
+                samples = stream_to_wav(note_stream(), files, k=n_k, amp=n_amp, sr=SAMPLE_RATE, dtype=dtype, **export)
+            st.add_samples(samples if channels is None else samples * channel_count(**channels))
+        outputs.update({v: export_file_name(f, export.get("format")) for v, f in files.items()})
+        out = None
+    elif incremental:
+        wav_files = {v: output_dir + prefix + v + "_txt.wav" for v in ["hrm", "sin", "tri"]}
+        renderer = IncrementalRenderer(wav_files, output_dir + prefix + "render_index.npz", k=n_k, amp=n_amp, sr=SAMPLE_RATE, dtype=dtype, **export)
+        with stage("synthesis"):
+            update = renderer.render(ns_values)
+        print("incremental render: {} ({} notes synthesized, {} samples written)".format(update["mode"], update["notes_rendered"], update["samples_written"]))
+        outputs.update(wav_files)
+        signals = renderer.signals()
+        out = [signals["hrm"], signals["sin"], signals["tri"], ns_values]
+    elif channels is not None:
+        with stage("synthesis") as st:
+            frames = render_channels(ns_values, amp=n_amp, sr=SAMPLE_RATE, k=n_k, dtype=dtype, **channels)
+            st.add_samples(frames.size)
+        out = [frames[:, i] for i in range(frames.shape[1])] + [ns_values]
+    else:
+        with stage("synthesis") as st:
+            out = generate_signals(ns_values, amp=n_amp, sr=SAMPLE_RATE, k=n_k, cache=cache, dtype=dtype)
+            st.add_samples(len(out[0]))
+    #print(out[-1])
 
     ######################################## MAKE WAV FILES #########################################
 
-    output_dir = "data_txt/"
-
-    with open(output_dir + "data.txt", "w") as tf:
-        for n in ns_values:
+    outputs["notes"] = output_dir + prefix + "data.txt"
+    num_notes = 0
+    with open(outputs["notes"], "w") as tf:
+        for n in note_stream():
             tf.write("{:0.2f} Hz, {:0.3f} seconds\n".format(n[0], n[1]))
+            num_notes += 1
 
-    create_midi_from_notes([(freq2midi(n[0]), n[1]) for n in ns_values], output_dir + "midi_data.mid")
+    outputs["midi"] = output_dir + prefix + "midi_data.mid"
+    create_midi_from_notes(((freq2midi(n[0]), n[1]) for n in note_stream()), outputs["midi"], stream=stream)
 
-    try:
-        sf.write(output_dir + "hrm_txt.wav", hrm, SAMPLE_RATE)
-    except:
-        sf.write("hrm_txt.wav", hrm, SAMPLE_RATE)
+    # streamed outputs were written while rendering
+    if channels is not None and not stream:
+        outputs.update(export_signals({name: frames}, {name: output_dir + prefix + name + "_txt.wav"}, SAMPLE_RATE, **export))
+    elif not (stream or incremental): # the incremental renderer has already updated the files
+        signals = {"hrm": out[0], "sin": out[1], "tri": out[2]}
+        outputs.update(export_signals(signals, {v: output_dir + prefix + v + "_txt.wav" for v in signals}, SAMPLE_RATE, **export))
 
-    try:
-        sf.write(output_dir + "sin_txt.wav", sin, SAMPLE_RATE)
-    except:
-        sf.write("sin_txt.wav", sin, SAMPLE_RATE)
+    entry = {
+        "input": input_file,
+        "outputs": outputs,
+        "notes": num_notes,
+        "samples": samples if stream else len(out[0]),
+        "seconds": time.perf_counter() - start,
+    }
+    return entry, out if signals_needed else None
 
+# caches are per process, so each pool worker keeps its envelopes, wavetables and
+# RenderCache warm across every file it is handed
+batch_state = {}
+
+def init_batch_worker(cache_dir, dtype, output_dir, export=None, channels=None, bounds=None):
+    batch_state["cache"] = RenderCache(cache_dir) if cache_dir else None
+    batch_state["bounds"] = bounds
+    batch_state["dtype"] = dtype
+    batch_state["output_dir"] = output_dir
+    batch_state["export"] = export
+    batch_state["channels"] = channels
+
+def batch_worker(input_file:str):
+    prefix = os.path.splitext(os.path.basename(input_file))[0] + "_"
     try:
-        sf.write(output_dir + "tri_txt.wav", tri, SAMPLE_RATE)
-    except:
-        sf.write("tri_txt.wav", tri, SAMPLE_RATE)
+        entry, out = sonify_file(input_file, batch_state["output_dir"], prefix, cache=batch_state["cache"], dtype=batch_state["dtype"], export=batch_state["export"], channels=batch_state["channels"], stream=True, bounds=batch_state["bounds"])
+    except Exception as e:
+        entry = {"input": input_file, "error": "{}: {}".format(type(e).__name__, e)}
+    return entry
 
-    ######################################### GRAPH OUTPUT ##########################################
+def batch_inputs(pattern:str) -> list:
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.txt")
+    return sorted(glob.glob(pattern, recursive=True))
 
-    PLOT_TITLE = "Signal Plots"
+def run_batch(pattern:str, output_dir:str, workers:int, cache_dir=None, dtype="float64", manifest_name="manifest.json", export=None, channels=None, bounds=None):
+    """
+    Sonify every file matching pattern (a glob, or a directory meaning every .txt in it) with
+    a pool of worker processes, then write a JSON manifest of what was produced. export,
+    channels and bounds are passed on to sonify_file for every file.
+    """
+    input_files = batch_inputs(pattern)
+    os.makedirs(output_dir, exist_ok=True)
+    print("sonifying {} files with {} workers".format(len(input_files), workers))
 
-    fig, axs = plt.subplots(3, 1, layout='constrained')
+    start = time.perf_counter()
+    entries = []
+    initargs = (cache_dir, dtype, output_dir, export, channels, bounds)
+    if workers > 1:
+        with Pool(workers, initializer=init_batch_worker, initargs=initargs) as pool:
+            for entry in pool.imap_unordered(batch_worker, input_files):
+                entries.append(entry)
+                print("{} ({}/{})".format(entry["input"], len(entries), len(input_files)) + (" FAILED: " + entry["error"] if "error" in entry else ""))
+    else:
+        init_batch_worker(*initargs)
+        for entry in map(batch_worker, input_files):
+            entries.append(entry)
+            print("{} ({}/{})".format(entry["input"], len(entries), len(input_files)) + (" FAILED: " + entry["error"] if "error" in entry else ""))
+    elapsed = time.perf_counter() - start
 
-    fig.align_labels()
-    fig.set_size_inches(8, 4)
-    fig.set_dpi(100)
-    fig.suptitle(PLOT_TITLE, fontsize=20)
+    entries.sort(key=lambda e: e["input"])
+    manifest = {
+        "pattern": pattern,
+        "files": len(input_files),
+        "failed": sum(1 for e in entries if "error" in e),
+        "seconds": elapsed,
+        "files_per_sec": len(input_files) / elapsed if elapsed > 0 else 0.0,
+        "entries": entries,
+    }
+    with open(os.path.join(output_dir, manifest_name), "w") as f:
+        json.dump(manifest, f, indent=2)
 
-    axs[0].plot([i/44100 for i in range(len(hrm))], hrm)
-    ax = axs[0]
-    ax.set_title("Harm")
-    ax.set_ylabel("Amplitude")
+    print("\n{} files in {:0.2f} sec ({:0.2f} files/sec), manifest saved as {}".format(
+        len(input_files), elapsed, manifest["files_per_sec"], os.path.join(output_dir, manifest_name)))
+    return manifest
 
-    axs[1].plot([i/44100 for i in range(len(sin))], sin)
-    ax = axs[1]
-    ax.set_title("Sine")
-    ax.set_ylabel("Amplitude")
+def main() -> None:
 
-    axs[2].plot([i/44100 for i in range(len(tri))], tri)
-    ax = axs[2]
-    ax.set_title("Tri")
-    ax.set_ylabel("Amplitude")
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("--batch", help="glob or directory of integer files to sonify instead of data_txt/input.txt")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes used by --batch")
+    parser.add_argument("--output-dir", default="data_txt/", help="where the outputs (and the --batch manifest) go")
+    parser.add_argument("--cache", nargs="?", const=RENDER_CACHE_DIR, help="reuse rendered notes and streams from this directory (default {})".format(RENDER_CACHE_DIR))
+    parser.add_argument("--incremental", action="store_true", help="only re-render the notes that changed since the last run")
+    parser.add_argument("--no-plot", action="store_true", help="headless, skip the signal plot (and matplotlib)")
+    parser.add_argument("--dtype", choices=["float64", "float32"], default="float64", help="sample type used for synthesis")
+    parser.add_argument("--range", nargs=2, type=int, metavar=("MIN", "MAX"), help="smallest and largest integer of the input, skips the pass over the file that finds them")
+    add_channel_args(parser)
+    add_export_args(parser)
+    add_profiling_args(parser)
+    args = parser.parse_args()
+    enable_profiling_from_args(args)
+    export = export_options_from_args(args)
+    channels = channel_options_from_args(args)
+    if channels is not None and args.incremental:
+        parser.error("--incremental writes a file per voice, it can't be used with --channels " + args.channels)
+    if args.incremental and (args.format not in (None, "wav") or args.rate or getattr(args, "normalize", None)):
+        parser.error("--incremental patches the WAV files in place, it can't be used with --format, --rate or --normalize")
+    if args.batch and args.incremental:
+        parser.error("--incremental keeps one render index, it can't be used with --batch")
 
-    ax.set_xlabel("Time (seconds)")
+    if args.batch:
+        run_batch(args.batch, args.output_dir, args.workers, args.cache, args.dtype, export=export, channels=channels, bounds=args.range)
+        print_profile_summary()
+        return
 
-    try:
-        fig.savefig(output_dir + PLOT_TITLE + ".png")
-    except:
-        fig.savefig(PLOT_TITLE + ".png")
+    cache = RenderCache(args.cache) if args.cache else None
+    output_dir = args.output_dir
+
+    #- specify info about note stream
+    n_amp = 0.7
+    n_k = 8
+    #ns_dur = [100, 100] # note duration range - see numbers_to_notes
+    ns_dur = 75
+
+    entry, out = sonify_file("data_txt/input.txt", output_dir, "", n_amp, n_k, ns_dur, cache=cache, dtype=args.dtype, incremental=args.incremental, export=export, channels=channels, stream=args.no_plot, bounds=args.range)
+
+    ######################################### GRAPH OUTPUT ##########################################
+
+    if not args.no_plot:
+        with stage("plotting"):
+            PLOT_TITLE = "Signal Plots"
+            plot_signals(out[:-1], output_dir + PLOT_TITLE + ".png", PLOT_TITLE, labels=("Left", "Right") if args.channels == "stereo" else ("Harm", "Sine", "Tri"))
 
-    #plt.show()
+    print_profile_summary()
 
 if __name__ == "__main__":
     main()
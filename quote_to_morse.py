@@ -1,6 +1,8 @@
-import matplotlib.pyplot as plt
-import soundfile as sf
+import numpy as np
 from sg_functions import *
+import argparse, functools, os
+
+DESCRIPTION = "turn a quote into morse code tones"
 
 # Define the Morse code dictionary for ASCII characters
 MORSE_CODE_DICT = {
@@ -55,8 +57,182 @@ def string_to_morse_tones(input_string, dit_len_ms=100, frequency=600):
 
     return note_values
 
+# the three units string_to_morse_tones is built from, as codes in a uint8 array
+MORSE_DIT, MORSE_DAH, MORSE_GAP = 0, 1, 2
+MORSE_BANK_CACHE_SIZE = 64
+
+def morse_code_units(code:str) -> bytes:
+    if code == '/':
+        return bytes([MORSE_GAP]*4)
+    units = []
+    for bit in code:
+        if bit == '.':
+            units.append(MORSE_DIT)
+        elif bit == '-':
+            units.append(MORSE_DAH)
+        else:
+            raise Exception('morse code borked')
+        units.append(MORSE_GAP)
+    return bytes(units + [MORSE_GAP]*2)
+
+MORSE_UNITS = {code: morse_code_units(code) for code in MORSE_CODE_DICT.values()}
+
+# string_to_morse_tones as unit codes, one per note it would produce
+def string_to_morse_units(input_string):
+    return np.frombuffer(b"".join(MORSE_UNITS[code] for code in string_to_morse(input_string)), dtype=np.uint8)
+
+@functools.lru_cache(maxsize=MORSE_BANK_CACHE_SIZE)
+def _cached_morse_bank(voice, frequency, dit_len_s, k, amp, sr, A, D, S, R, dtype):
+    bank = []
+    for freq, dur in [(frequency, dit_len_s), (frequency, 3*dit_len_s), (0, dit_len_s)]:
+        signal = render_voices([[freq, dur]], (voice,), k=k, amp=amp, sr=sr, A=A, D=D, S=S, R=R, dtype=dtype)[voice]
+        signal.flags.writeable = False
+        bank.append(signal)
+    return bank
+
+def morse_bank(voice:str, frequency:float, dit_len_ms=100, k=8, amp=1.0, sr=44100, A=0.04, D=0.06, S=0.6, R=0.05, dtype=np.float64):
+    """
+    The dit, dah and gap of one voice, each rendered once exactly as render_voices would render
+    that note, indexed by MORSE_DIT, MORSE_DAH and MORSE_GAP. The arrays are shared, read-only.
+    """
+    return _cached_morse_bank(voice, float(frequency), dit_len_ms/1000, k, float(amp), int(sr), float(A), float(D), float(S), float(R), np.dtype(dtype))
+
+def render_morse(input_string, voices=("hrm", "sin", "tri"), dit_len_ms=100, frequency=600, k=8, amp=1.0, sr=44100,
+                 A=0.04, D=0.06, S=0.6, R=0.05, dtype=np.float64):
+    """
+    Same signals as render_voices(string_to_morse_tones(input_string, dit_len_ms, frequency), ...),
+    assembled by copying the voice's dit and dah buffers from morse_bank into a preallocated
+    array. Gaps are left as the zeros the array starts with.
+
+    Returns:
+        Dictionary mapping each voice name to its signal
+    """
+    units = string_to_morse_units(input_string)
+    out = {}
+    for v in voices:
+        bank = morse_bank(v, frequency, dit_len_ms, k, amp, sr, A, D, S, R, dtype)
+        lengths = np.array([len(b) for b in bank])[units]
+        starts = np.concatenate(([0], np.cumsum(lengths)))
+        signal = np.zeros(starts[-1], dtype=dtype)
+        with stage("mix", len(signal)):
+            for unit in (MORSE_DIT, MORSE_DAH):
+                buf = bank[unit]
+                for start in starts[:-1][units == unit].tolist():
+                    signal[start:start+len(buf)] = buf
+        out[v] = signal
+    return out
+
+def render_morse_blocks(input_string, voices=("hrm", "sin", "tri"), block_size=BLOCK_SIZE, dit_len_ms=100, frequency=600, k=8, amp=1.0, sr=44100,
+                        A=0.04, D=0.06, S=0.6, R=0.05, dtype=np.float64):
+    """
+    Block by block version of render_morse for write_blocks, the same samples without ever
+    holding a whole signal: every block is filled from the dit and dah buffers that overlap it.
+
+    Yields:
+        Dictionary mapping each voice name to a block of block_size samples, the last block
+        is shorter
+    """
+    units = string_to_morse_units(input_string)
+    banks = {v: morse_bank(v, frequency, dit_len_ms, k, amp, sr, A, D, S, R, dtype) for v in voices}
+    dit_len_s = dit_len_ms/1000 # the durations exactly as string_to_morse_tones computes them
+    lengths = np.array([ADSR_length(d, R, sr) for d in (dit_len_s, 3*dit_len_s, dit_len_s)])[units]
+    starts = np.concatenate(([0], np.cumsum(lengths)))
+    for block_start in range(0, int(starts[-1]), block_size):
+        block_end = min(block_start + block_size, int(starts[-1]))
+        blocks = {v: np.zeros(block_end - block_start, dtype=dtype) for v in voices}
+        with stage("mix", len(blocks) * (block_end - block_start)):
+            first = int(np.searchsorted(starts, block_start, side="right")) - 1
+            last = int(np.searchsorted(starts, block_end, side="left"))
+            for i in range(first, last):
+                if units[i] == MORSE_GAP:
+                    continue
+                start = int(starts[i])
+                lo, hi = max(start, block_start), min(int(starts[i+1]), block_end)
+                for v in voices:
+                    blocks[v][lo-block_start:hi-block_start] = banks[v][units[i]][lo-start:hi-start]
+        yield blocks
+
+def render_morse_channels(input_string, voices=("hrm", "sin", "tri"), pan=None, gain=None, dit_len_ms=100, frequency=600, k=8, amp=1.0, sr=44100,
+                          A=0.04, D=0.06, S=0.6, R=0.05, dtype=np.float64):
+    """
+    Same array as render_channels(string_to_morse_tones(input_string, dit_len_ms, frequency), ...),
+    one channel per voice or a stereo mix with pan and gain. The dit and dah are mixed into
+    their channels once, every note is then a single copy of those frames.
+
+    Returns:
+        Array of shape (samples, len(voices)), or (samples, 2) with pan
+    """
+    units = string_to_morse_units(input_string)
+    gains = [(gain or {}).get(v, 1.0) for v in voices]
+    banks = [morse_bank(v, frequency, dit_len_ms, k, amp, sr, A, D, S, R, dtype) for v in voices]
+    if pan is None:
+        mix = np.diag(gains)
+    else:
+        mix = np.array([[g * p for p in pan_gains(pan.get(v, 0.0))] for v, g in zip(voices, gains)]).reshape(len(voices), 2)
+
+    # every voice's dit, dah and gap have the same length, the layout only depends on the units
+    dit_len_s = dit_len_ms/1000 # the durations exactly as string_to_morse_tones computes them
+    lengths = np.array([ADSR_length(d, R, sr) for d in (dit_len_s, 3*dit_len_s, dit_len_s)])[units]
+    starts = np.concatenate(([0], np.cumsum(lengths)))
+    out = np.zeros((starts[-1], mix.shape[1]), dtype=dtype)
+    if not voices:
+        return out
+    with stage("mix", out.size):
+        for unit in (MORSE_DIT, MORSE_DAH):
+            frames = (np.stack([bank[unit] for bank in banks], axis=1) @ mix).astype(dtype)
+            n = len(frames)
+            for start in starts[:-1][units == unit].tolist():
+                out[start:start+n] = frames
+    return out
+
+def write_morse(input_string, files:dict, channels=None, export=None, sr=44100, dtype=np.float64, **kwargs) -> int:
+    """
+    Render a quote straight to its WAV files block by block (render_morse_blocks, write_blocks).
+    files maps each voice to its file, or with channels (render_channels options) holds the
+    one file every voice is mixed into. export are the write_blocks options and kwargs the
+    render_morse parameters. Returns the number of samples written per file.
+    """
+    if channels is None:
+        blocks = render_morse_blocks(input_string, tuple(files), sr=sr, dtype=dtype, **kwargs)
+        return write_blocks(blocks, files, sr, **(export or {}))
+    blocks = render_morse_blocks(input_string, channels["voices"], sr=sr, dtype=dtype, **kwargs)
+    frames = ({name: block for name in files} for block in channel_blocks(blocks, **channels, dtype=dtype))
+    return write_blocks(frames, files, sr, channels=channel_count(**channels), **(export or {}))
+
+def render_morse_batch(input_strings, voices=("hrm", "sin", "tri"), **kwargs):
+    """
+    render_morse for many quotes, every one with the same symbol bank. kwargs are the
+    render_morse parameters.
+
+    Yields:
+        A voice dictionary per quote, so a corpus never has to fit in memory at once
+    """
+    for input_string in input_strings:
+        yield render_morse(input_string, voices, **kwargs)
+
 def main() -> None:
 
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("--batch", help="text file with one quote per line, each is written to data_quote/{voice}_{line}.wav (or voices_/stereo_{line}.wav)")
+    parser.add_argument("--cache", nargs="?", const=RENDER_CACHE_DIR, help="reuse rendered notes and streams from this directory (default {})".format(RENDER_CACHE_DIR))
+    parser.add_argument("--incremental", action="store_true", help="only re-render the notes that changed since the last run")
+    parser.add_argument("--no-plot", action="store_true", help="headless, skip the signal plot (and matplotlib)")
+    parser.add_argument("--dtype", choices=["float64", "float32"], default="float64", help="sample type used for synthesis")
+    add_channel_args(parser)
+    add_export_args(parser)
+    add_profiling_args(parser)
+    args = parser.parse_args()
+    enable_profiling_from_args(args)
+    export = export_options_from_args(args)
+    channels = channel_options_from_args(args)
+    if channels is not None and args.incremental:
+        parser.error("--incremental writes a file per voice, it can't be used with --channels " + args.channels)
+    if args.incremental and (args.format not in (None, "wav") or args.rate or getattr(args, "normalize", None)):
+        parser.error("--incremental patches the WAV files in place, it can't be used with --format, --rate or --normalize")
+    if args.batch and (args.cache or args.incremental):
+        parser.error("--batch renders every quote in one pass, it can't be used with --cache or --incremental")
+    cache = RenderCache(args.cache) if args.cache else None
+
     ######################################## SET UP NOTE STREAM #########################################
 
     #- specify info about note stream
@@ -70,82 +246,93 @@ def main() -> None:
     input_string2 = "the opposite of poverty is not wealth; the opposite of poverty is enough" # Wess Stafford
     input_string3 = "our lives begin to end the day we become silent about things that matter" # Martin Luther King Jr.
 
-    input_tones1 = string_to_morse_tones(input_string1, dit_len_ms=dit_len_ms, frequency=freq)
-    input_tones2 = string_to_morse_tones(input_string2, dit_len_ms=dit_len_ms, frequency=freq)
-    input_tones3 = string_to_morse_tones(input_string3, dit_len_ms=dit_len_ms, frequency=freq)
+    with stage("parse"):
+        input_tones1 = string_to_morse_tones(input_string1, dit_len_ms=dit_len_ms, frequency=freq)
+        input_tones2 = string_to_morse_tones(input_string2, dit_len_ms=dit_len_ms, frequency=freq)
+        input_tones3 = string_to_morse_tones(input_string3, dit_len_ms=dit_len_ms, frequency=freq)
 
     # choose input string here to indicate the string you want and a suffix for the output files
     file_suffix = "stafford"
+    input_string = input_string2
     ns_values = input_tones2
 
+    output_dir = "data_quote/"
+    os.makedirs(output_dir, exist_ok=True)
+    morse_args = dict(dit_len_ms=dit_len_ms, frequency=freq, k=n_k, amp=amplitude, A=0.01, D=0.0, S=1.0, R=0.01, sr=SAMPLE_RATE, dtype=args.dtype)
+    layout = "stereo" if args.channels == "stereo" else "voices" # file name of the one multichannel file
+
+    if args.batch:
+        with open(args.batch, encoding="utf-8") as f:
+            quotes = [line.strip() for line in f if line.strip()]
+        with stage("synthesis"):
+            for line, quote in enumerate(quotes):
+                if channels is not None:
+                    files = {layout: output_dir + "{}_{}.wav".format(layout, line)}
+                else:
+                    files = {v: output_dir + "{}_{}.wav".format(v, line) for v in ["hrm", "sin", "tri"]}
+                if not export.get("normalize"):
+                    write_morse(quote, files, channels, export, **morse_args)
+                elif channels is not None: # normalize needs the whole signals
+                    export_signals({layout: render_morse_channels(quote, **channels, **morse_args)}, files, SAMPLE_RATE, **export)
+                else:
+                    export_signals(render_morse(quote, **morse_args), files, SAMPLE_RATE, **export)
+        print("{} quotes written to {}".format(len(quotes), output_dir))
+        print_profile_summary()
+        return
+
     ######################################## GEN SIGNAL #########################################
 
     #print(ns_values)
-    out = generate_signals(ns_values, amp=amplitude, k=n_k, A=0.01, D=0.0, S=1.0, R=0.01, sr=SAMPLE_RATE)
-    hrm = out[0]
-    sin = out[1]
-    tri = out[2]
-    #print(out[3])
+    wav_files = {v: output_dir + v + "_" + file_suffix + ".wav" for v in ["hrm", "sin", "tri"]}
+    # without a plot, cache, incremental files or normalize nothing needs the whole signals,
+    # so they are rendered and written block by block in bounded memory
+    stream = args.no_plot and cache is None and not args.incremental and not export.get("normalize")
+    with stage("synthesis") as st:
+        if stream:
+            files = {layout: output_dir + layout + "_" + file_suffix + ".wav"} if channels is not None else wav_files
+            samples = write_morse(input_string, files, channels, export, **morse_args)
+        elif args.incremental:
+            # only the notes that changed since the last run with this suffix are synthesized
+            renderer = IncrementalRenderer(wav_files, output_dir + "render_index_" + file_suffix + ".npz", k=n_k, amp=amplitude, A=0.01, D=0.0, S=1.0, R=0.01, sr=SAMPLE_RATE, dtype=args.dtype, **export)
+            update = renderer.render(ns_values)
+            print("incremental render: {} ({} notes synthesized, {} samples written)".format(update["mode"], update["notes_rendered"], update["samples_written"]))
+            voices = renderer.signals()
+            out = [voices["hrm"], voices["sin"], voices["tri"], ns_values]
+        elif channels is not None:
+            # every voice in one (samples, channels) array, written as a single file
+            frames = render_morse_channels(input_string, **channels, **morse_args)
+            out = [frames[:, i] for i in range(frames.shape[1])] + [ns_values]
+        elif cache is not None:
+            out = generate_signals(ns_values, amp=amplitude, k=n_k, A=0.01, D=0.0, S=1.0, R=0.01, sr=SAMPLE_RATE, cache=cache, dtype=args.dtype)
+        else:
+            # same samples as generate_signals, copied from one dit, dah and gap per voice
+            voices = render_morse(input_string, **morse_args)
+            out = [voices["hrm"], voices["sin"], voices["tri"], ns_values]
+        st.add_samples(samples if stream else len(out[0]))
+    #print(out[-1])
 
     ######################################## MAKE WAV FILES #########################################
 
-    output_dir = "data_quote/"
-
     with open(output_dir + "data_" + file_suffix + ".txt", "w") as tf:
         for n in ns_values:
             tf.write("{:0.2f} Hz, {:0.3f} seconds\n".format(n[0], n[1]))
 
     create_midi_from_notes([(freq2midi(n[0]), n[1]) for n in ns_values], output_dir + "midi_data_" + file_suffix + ".mid")
 
-    try:
-        sf.write(output_dir + "hrm_" + file_suffix + ".wav", hrm, SAMPLE_RATE)
-    except:
-        sf.write("hrm_" + file_suffix + ".wav", hrm, SAMPLE_RATE)
-
-    try:
-        sf.write(output_dir + "sin_" + file_suffix + ".wav", sin, SAMPLE_RATE)
-    except:
-        sf.write("sin_" + file_suffix + ".wav", sin, SAMPLE_RATE)
-
-    try:
-        sf.write(output_dir + "tri_" + file_suffix + ".wav", tri, SAMPLE_RATE)
-    except:
-        sf.write("tri_" + file_suffix + ".wav", tri, SAMPLE_RATE)
+    # streamed outputs were written while rendering
+    if channels is not None and not stream:
+        export_signals({layout: frames}, {layout: output_dir + layout + "_" + file_suffix + ".wav"}, SAMPLE_RATE, **export)
+    elif not (stream or args.incremental): # the incremental renderer has already updated the files
+        export_signals({"hrm": out[0], "sin": out[1], "tri": out[2]}, wav_files, SAMPLE_RATE, **export)
 
     ######################################### GRAPH OUTPUT ##########################################
 
-    PLOT_TITLE = "Signal Plots"
-
-    fig, axs = plt.subplots(3, 1, layout='constrained')
-
-    fig.align_labels()
-    fig.set_size_inches(8, 4)
-    fig.set_dpi(100)
-    fig.suptitle(PLOT_TITLE, fontsize=20)
-
-    axs[0].plot([i/44100 for i in range(len(hrm))], hrm)
-    ax = axs[0]
-    ax.set_title("Harm")
-    ax.set_ylabel("Amplitude")
-
-    axs[1].plot([i/44100 for i in range(len(sin))], sin)
-    ax = axs[1]
-    ax.set_title("Sine")
-    ax.set_ylabel("Amplitude")
-
-    axs[2].plot([i/44100 for i in range(len(tri))], tri)
-    ax = axs[2]
-    ax.set_title("Tri")
-    ax.set_ylabel("Amplitude")
-
-    ax.set_xlabel("Time (seconds)")
-
-    try:
-        fig.savefig(output_dir + PLOT_TITLE + ".png")
-    except:
-        fig.savefig(PLOT_TITLE + ".png")
+    if not args.no_plot:
+        with stage("plotting"):
+            PLOT_TITLE = "Signal Plots"
+            plot_signals(out[:-1], output_dir + PLOT_TITLE + ".png", PLOT_TITLE, labels=("Left", "Right") if args.channels == "stereo" else ("Harm", "Sine", "Tri"))
 
-    #plt.show()
+    print_profile_summary()
 
 if __name__ == "__main__":
     main()
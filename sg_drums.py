@@ -0,0 +1,146 @@
+import numpy as np
+from sg_functions import *
+import argparse, functools, os
+
+# drum voices from kick.ipynb and snare.ipynb, plus a step sequencer to play them
+#
+#   python sg_drums.py                   writes data_drums/kick_drum.wav, snare_drum.wav and a loop
+#
+# one-shots are rendered once per set of parameters and cached read-only, a pattern is laid into
+# a preallocated buffer by adding the cached one-shot at every hit's offset
+
+DRUM_CACHE_SIZE = 64
+
+def drum_tone(freq:float, amp:float, duration:float, A:float, D:float, S:float, R:float, sr:int=44100):
+    # sine at the nearest MIDI note under an ADSR envelope, as in the notebooks
+    envelope = build_ADSR_envelope(duration, A, D, S, R, sr)
+    t = np.arange(len(envelope)) / sr
+    return amp * np.sin(2*np.pi*midi2freq(freq2midi(freq))*t) * envelope
+
+def kick_drum(freq:float=185/3, amp:float=1.0, duration:float=0.1, A:float=0.0, D:float=0.1, S:float=0.3, R:float=0.2, sr:int=44100):
+    return drum_tone(freq, amp, duration, A, D, S, R, sr)
+
+def snare_drum(freq:float=185, amp:float=1.0, duration:float=0.1, A:float=0.0, D:float=0.127, S:float=0.91, R:float=0.2,
+               tone_gain:float=0.6, noise_ratio:float=0.9, noise_D:float=0.1, noise_S:float=0.15, noise_R:float=0.15, seed:int=0, sr:int=44100):
+    tone = drum_tone(freq, amp, duration, A, D, S, R, sr)
+
+    # enveloped white noise, shorter than the tone and padded with silence to its length.
+    # seeded so the cached one-shot is the same sound every run
+    noise_envelope = build_ADSR_envelope(duration*noise_ratio, 0.0, noise_D, noise_S, noise_R, sr)
+    noise = np.zeros(len(tone))
+    n = min(len(noise_envelope), len(tone))
+    noise[0:n] = amp * np.random.default_rng(seed).uniform(-1, 1, n) * noise_envelope[0:n]
+
+    return tone_gain*tone + noise
+
+DRUMS = {"kick": kick_drum, "snare": snare_drum}
+
+def register_drum(name:str, generator):
+    """
+    Add a drum that patterns can use by name. generator(**params, sr=sr) returns the
+    one-shot as a float64 array.
+    """
+    DRUMS[name] = generator
+    _cached_drum.cache_clear()
+
+@functools.lru_cache(maxsize=DRUM_CACHE_SIZE)
+def _cached_drum(name, params, sr, dtype):
+    sample = DRUMS[name](**dict(params), sr=sr).astype(dtype)
+    sample.flags.writeable = False
+    return sample
+
+def drum_sample(name:str, sr:int=44100, dtype=np.float64, **params):
+    """
+    Cached one-shot of a drum in DRUMS, params override the generator's defaults.
+    The returned array is read-only.
+    """
+    if name not in DRUMS:
+        raise Exception("unknown drum '{}'".format(name))
+    return _cached_drum(name, tuple(sorted(params.items())), int(sr), np.dtype(dtype))
+
+def drum_cache_info():
+    return _cached_drum.cache_info()
+
+# velocity of each step character in a pattern string, anything else is a rest
+STEP_VELOCITIES = {"x": 1.0, "X": 1.0, "o": 0.5}
+
+def pattern_steps(steps):
+    # a pattern row as velocities, from a string like "x..o x..." (spaces ignored) or a list
+    if isinstance(steps, str):
+        return [STEP_VELOCITIES.get(c, 0.0) for c in steps if c != " "]
+    return [float(v) for v in steps]
+
+def render_pattern(pattern:dict, bpm:float=120, steps_per_beat:int=4, repeats:int=1, amp:float=1.0, sr:int=44100,
+                   dtype=np.float64, drum_params:dict=None):
+    """
+    Render a step sequencer pattern.
+
+    Args:
+        pattern: Dictionary mapping drum names to rows of steps, e.g. {"kick": "x...x...",
+                 "snare": "..x...x."} or lists of velocities, rows loop on their own length
+        bpm, steps_per_beat: Tempo and step size (4 = sixteenth notes)
+        repeats: How many times the longest row is played
+        amp: Overall gain on top of each hit's velocity
+        drum_params: Optional dictionary of drum name to parameters for drum_sample
+
+    Returns:
+        The mixed signal, repeats bars long or longer if the last hits ring past the end
+    """
+    drum_params = drum_params or {}
+    step_len = 60 / bpm / steps_per_beat * sr # in samples, may be fractional
+    rows = {name: pattern_steps(steps) for name, steps in pattern.items()}
+    total_steps = max((len(r) for r in rows.values()), default=0) * repeats
+
+    hits = {} # drum -> (offsets, velocities)
+    for name, row in rows.items():
+        if not row:
+            continue
+        steps = np.arange(total_steps)
+        velocities = np.array(row)[steps % len(row)]
+        on = velocities > 0
+        # offsets from the step index, so a long pattern doesn't drift off the grid
+        hits[name] = (np.round(steps[on] * step_len).astype(np.int64), velocities[on] * amp)
+
+    samples = {name: drum_sample(name, sr, dtype, **drum_params.get(name, {})) for name in hits}
+    length = int(round(total_steps * step_len))
+    for name, (offsets, velocities) in hits.items():
+        if len(offsets):
+            length = max(length, int(offsets[-1]) + len(samples[name]))
+
+    out = np.zeros(length, dtype=dtype)
+    with stage("drum hits", sum(len(o) * len(samples[n]) for n, (o, v) in hits.items())):
+        for name, (offsets, velocities) in hits.items():
+            sample = samples[name]
+            n = len(sample)
+            for offset, velocity in zip(offsets.tolist(), velocities.tolist()):
+                if velocity == 1.0:
+                    out[offset:offset+n] += sample
+                else:
+                    out[offset:offset+n] += velocity * sample
+    return out
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description="render the kick and snare one-shots and a drum loop")
+    parser.add_argument("--bpm", type=float, default=120)
+    parser.add_argument("--bars", type=int, default=8, help="length of the loop")
+    parser.add_argument("--output-dir", default="data_drums/")
+    add_export_args(parser)
+    add_profiling_args(parser)
+    args = parser.parse_args()
+    enable_profiling_from_args(args)
+
+    output_dir = os.path.join(args.output_dir, "")
+    pattern = {
+        "kick":  "x...x...x...x...",
+        "snare": "....x..o....x...",
+    }
+
+    loop = render_pattern(pattern, bpm=args.bpm, repeats=args.bars, amp=0.5)
+    signals = {"kick_drum": drum_sample("kick"), "snare_drum": drum_sample("snare"), "drum_loop": loop}
+    export_signals(signals, {name: output_dir + name + ".wav" for name in signals}, SAMPLE_RATE, **export_options_from_args(args))
+
+    print_profile_summary()
+
+if __name__ == "__main__":
+    main()
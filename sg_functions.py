@@ -1,27 +1,201 @@
 import numpy as np
 import math
-import mido
-from mido import Message, MidiFile, MidiTrack
+import functools
+import hashlib
+import io
+import os
+import time
+import tracemalloc
+import soundfile as sf
 import re
+import threading
+
+# mido and matplotlib are only imported by the functions that need them, so scripts that
+# don't write MIDI or plots (or run headless) don't pay their import time
 
 # functions defined for use in this repository, common to almost every script
 
 SAMPLE_RATE = 44100
 
+######################################## PROFILING #########################################
+
+# per-stage timing for the generation pipelines, off unless enable_profiling is called
+#
+#     enable_profiling(trace_malloc=True)
+#     with stage("parse") as s:
+#         notes = ...
+#         s.add_samples(len(notes))
+#     print_profile_summary()
+
+class NullStage:
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+    def add_samples(self, n:int):
+        pass
+
+NULL_STAGE = NullStage()
+
+class Stage:
+    def __init__(self, profiler, name:str, samples:int):
+        self.profiler = profiler
+        self.name = name
+        self.samples = samples
+
+    def add_samples(self, n:int):
+        self.samples += n
+
+    def __enter__(self):
+        # tracemalloc's peak is process wide, only stages of the main thread nest and track it,
+        # stages in worker threads (e.g. export_signals) record time and samples
+        self.traced = self.profiler.trace_malloc and threading.current_thread() is threading.main_thread()
+        if self.traced:
+            # hand the peak seen so far to the enclosing stage before resetting it for this one
+            current, peak = tracemalloc.get_traced_memory()
+            if self.profiler.open_stages:
+                parent = self.profiler.open_stages[-1]
+                parent.peak = max(parent.peak, peak)
+            tracemalloc.reset_peak()
+            self.mem_start = self.peak = current
+            self.profiler.open_stages.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        with self.profiler.lock:
+            record = self.profiler.stages.setdefault(self.name, {"calls": 0, "seconds": 0.0, "samples": 0, "peak_alloc_bytes": 0})
+            if self.traced:
+                self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+                self.profiler.open_stages.pop()
+                if self.profiler.open_stages:
+                    parent = self.profiler.open_stages[-1]
+                    parent.peak = max(parent.peak, self.peak)
+                record["peak_alloc_bytes"] = max(record["peak_alloc_bytes"], self.peak - self.mem_start)
+            record["calls"] += 1
+            record["seconds"] += elapsed
+            record["samples"] += self.samples
+        return False
+
+class Profiler:
+    """
+    Collects wall time, sample counts and (with trace_malloc) the largest amount of memory
+    allocated above its starting point during any call, per stage name. Stages may nest, an
+    outer stage's time and memory include its inner stages. Stages may run in several threads,
+    memory is only traced for those of the main thread.
+    """
+    def __init__(self, cprofile:bool=False, trace_malloc:bool=False):
+        self.stages = {}
+        self.open_stages = [] # main thread only
+        self.lock = threading.Lock()
+        self.trace_malloc = trace_malloc
+        self.cprofile = None
+        self.start = time.perf_counter()
+        if trace_malloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if cprofile:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def stop(self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        if self.trace_malloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.total = time.perf_counter() - self.start
+
+    def summary(self) -> dict:
+        total = getattr(self, "total", time.perf_counter() - self.start)
+        stages = {}
+        for name, r in self.stages.items():
+            stages[name] = dict(r, samples_per_sec=r["samples"] / r["seconds"] if r["seconds"] > 0 else 0.0)
+        return {"total_seconds": total, "stages": stages}
+
+    def report(self, cprofile_lines:int=20) -> str:
+        s = self.summary()
+        lines = ["{:24s} {:>7s} {:>10s} {:>12s} {:>14s} {:>10s}".format("stage", "calls", "seconds", "samples", "samples/sec", "peak MB")]
+        for name, r in s["stages"].items():
+            lines.append("{:24s} {:7d} {:10.4f} {:12d} {:14.4g} {:10.2f}".format(
+                name, r["calls"], r["seconds"], r["samples"], r["samples_per_sec"], r["peak_alloc_bytes"] / 2**20))
+        lines.append("total: {:0.4f} sec".format(s["total_seconds"]))
+        if self.cprofile is not None:
+            import pstats
+            out = io.StringIO()
+            pstats.Stats(self.cprofile, stream=out).sort_stats("cumulative").print_stats(cprofile_lines)
+            lines.append(out.getvalue())
+        return "\n".join(lines)
+
+PROFILER = None
+
+def enable_profiling(cprofile:bool=False, trace_malloc:bool=False) -> Profiler:
+    """
+    Start recording stages, optionally under cProfile and/or tracemalloc. Replaces any
+    profiler already running.
+    """
+    global PROFILER
+    if PROFILER is not None:
+        PROFILER.stop()
+    PROFILER = Profiler(cprofile=cprofile, trace_malloc=trace_malloc)
+    return PROFILER
+
+def disable_profiling():
+    """Stop recording and return the finished Profiler (None if profiling was off)."""
+    global PROFILER
+    profiler, PROFILER = PROFILER, None
+    if profiler is not None:
+        profiler.stop()
+    return profiler
+
+# context manager timing one stage, a shared do-nothing object while profiling is off
+def stage(name:str, samples:int=0):
+    if PROFILER is None:
+        return NULL_STAGE
+    return Stage(PROFILER, name, samples)
+
+def profile_summary() -> dict:
+    return PROFILER.summary() if PROFILER is not None else {"total_seconds": 0.0, "stages": {}}
+
+def print_profile_summary(profiler=None):
+    profiler = profiler or PROFILER
+    if profiler is not None:
+        print(profiler.report())
+
+def add_profiling_args(parser):
+    parser.add_argument("--profile", action="store_true", help="print time, samples and memory per pipeline stage")
+    parser.add_argument("--cprofile", action="store_true", help="also run under cProfile and print the top functions")
+    parser.add_argument("--tracemalloc", action="store_true", help="also trace peak memory per stage")
+
+def enable_profiling_from_args(args):
+    if args.profile or args.cprofile or args.tracemalloc:
+        enable_profiling(cprofile=args.cprofile, trace_malloc=args.tracemalloc)
+
 def freq2midi(freq: float):
     return int(12 * math.log2(freq/440) + 69) if freq > 0 else 0
 
 def midi2freq(note_num: int):
     return 440 * pow(2, (note_num - 69) / 12) if note_num >= 0 and note_num < 128 else 0
 
-def generate_triangle(note_num: int, amp: float, duration: float, num_sinusoids: int, sr: int):
+# length of np.arange(0, duration, 1.0/sr), without building it
+def num_samples(duration:float, sr:int) -> int:
+    return max(0, math.ceil(duration / (1.0/sr)))
+
+# number of odd harmonics (1, 3, 5, ...) of freq that sit below the Nyquist frequency
+def odd_harmonics_below_nyquist(freq:float, sr:int) -> int:
+    return max(0, math.ceil((sr/(2*freq) - 1) / 2)) if freq > 0 else 0
+
+# additive triangle wave, band_limited stops the series at the Nyquist frequency since
+# anything above it only folds back down as aliasing (and costs a full np.sin pass each)
+def generate_triangle(note_num: int, amp: float, duration: float, num_sinusoids: int=1000, sr: int=44100, band_limited: bool=True):
     freq = midi2freq(note_num)
+    if band_limited:
+        num_sinusoids = min(num_sinusoids, odd_harmonics_below_nyquist(freq, sr))
     t = np.arange(0, duration, 1.0/sr)
     output = 0*t
     for i in range(num_sinusoids):
         n = 2*i+1
-        new_harm = (pow(-1,i)/pow(n,2)) * np.sin(2*np.pi*freq*n*t)
-        output = np.add(output, new_harm)
+        output += (pow(-1,i)/pow(n,2)) * np.sin(2*np.pi*freq*n*t)
     return np.multiply(output, amp*8/pow(np.pi,2))
 
 def generate_sine(note_num: int, amp: float, duration: float, sr: int):
@@ -35,116 +209,1262 @@ def k_harmonics(k, amp, freq, duration, sr):
         output = np.add(output, new_harm)
     return output
 
-def generate_ADSR_envelope(duration:float, A:float=0.04, D:float=0.06, S:float=0.6, R:float=0.05, sr:int=44100):
-    attack  = np.array([             i/A for i in np.arange(0,        A, 1.0/sr)])
-    decay   = np.array([ (1-((1-S)/D)*i) for i in np.arange(0,        D, 1.0/sr)])
-    sustain = np.array([               S for i in np.arange(0, duration, 1.0/sr)])
-    ADS = np.append(np.append(attack, decay), sustain)[0:int(duration*sr)]
+WAVETABLE_SIZE = 4096
+WAVETABLE_CACHE_SIZE = 256
+
+# harmonic numbers and weights of each waveform, the same series the generators above sum
+def waveform_harmonics(waveform:str, freq:float, k:int, sr:int):
+    if waveform == "sin":
+        harmonics = [(1, 1.0)]
+    elif waveform == "hrm":
+        harmonics = [(n+1, 1/(n+1)) for n in range(k)]
+    elif waveform == "tri":
+        harmonics = [(2*i+1, 8/pow(np.pi,2) * pow(-1,i)/pow(2*i+1,2)) for i in range(k)]
+    else:
+        raise Exception("unknown waveform '{}'".format(waveform))
+    return [(n, w) for n, w in harmonics if n*freq < sr/2]
+
+@functools.lru_cache(maxsize=WAVETABLE_CACHE_SIZE)
+def wavetable(waveform:str, freq:float, k:int, sr:int, dtype=np.float64):
+    """
+    One band-limited cycle of a waveform at a given pitch, cached per (waveform, k, freq, sr, dtype).
+
+    Only harmonics below the Nyquist frequency of that pitch are summed, so the table can be
+    played back without aliasing. The table holds WAVETABLE_SIZE samples plus a copy of the
+    first one at the end so interpolation never has to wrap. It is summed in float64 and
+    stored as dtype, read-only.
+    """
+    phase = 2*np.pi * np.arange(WAVETABLE_SIZE + 1) / WAVETABLE_SIZE
+    table = np.zeros(WAVETABLE_SIZE + 1)
+    for n, w in waveform_harmonics(waveform, freq, k, sr):
+        table += w * np.sin(n*phase)
+    table[-1] = table[0]
+    table = table.astype(dtype)
+    table.flags.writeable = False
+    return table
+
+def wavetable_cache_info():
+    return wavetable.cache_info()
+
+def wavetable_oscillator(waveform:str, freq:float, amp:float, length:int, k:int=8, sr:int=44100, dtype=np.float64, start:int=0):
+    """
+    Render length samples of a waveform by linear interpolation into its cached wavetable.
+
+    The phase of every sample is taken from its index (i*freq/sr), not accumulated
+    sample by sample, so long notes don't drift out of tune and a note can be rendered
+    in slices that join up exactly.
+
+    Args:
+        waveform: "hrm" (k harmonics at 1/n), "sin" or "tri" (k odd harmonics at 1/n^2)
+        freq: Frequency in Hz
+        amp: Peak amplitude of the fundamental
+        length: Number of samples to render
+        k: Number of harmonics in the waveform's series
+        sr: Sample rate
+        dtype: Sample type of the output, the phase is always tracked in float64
+        start: Index of the first sample within the note
+    """
+    table = wavetable(waveform, float(freq), int(k), int(sr), np.dtype(dtype))
+    position = np.arange(start, start + length) * (freq/sr)
+    position -= np.floor(position)
+    position *= WAVETABLE_SIZE
+    index = position.astype(np.intp)
+    position -= index
+    output = table[index + 1] - table[index]
+    output *= position.astype(dtype, copy=False)
+    output += table[index]
+    output *= amp
+    return output
+
+# builds an ADSR envelope (0 to 1) covering the note duration plus its release
+def build_ADSR_envelope(duration:float, A:float=0.04, D:float=0.06, S:float=0.6, R:float=0.05, sr:int=44100):
+    return _ADSR_from_length(int(duration*sr), A, D, S, R, sr)
+
+# the envelope only depends on the duration through its sustained length in samples
+def _ADSR_from_length(length:int, A:float, D:float, S:float, R:float, sr:int):
+    t = np.arange(0, max(A, D, R), 1.0/sr)
+    attack  = t[0:num_samples(A, sr)] / A if A > 0 else t[0:0]
+    decay   = 1 - ((1-S)/D)*t[0:num_samples(D, sr)] if D > 0 else t[0:0]
+    ADS = np.concatenate((attack, decay, np.full(length, float(S))))[0:length]
     last = ADS[-1]
-    release = np.array([(-last/R*i+last) for i in np.arange(0,        R, 1.0/sr)])
-    return np.array([i*100 for i in np.append(ADS, release)])
+    release = -last/R*t[0:num_samples(R, sr)] + last if R > 0 else t[0:0]
+    return np.concatenate((ADS, release))
+
+def generate_ADSR_envelope(duration:float, A:float=0.04, D:float=0.06, S:float=0.6, R:float=0.05, sr:int=44100):
+    return build_ADSR_envelope(duration, A, D, S, R, sr) * 100
+
+ADSR_CACHE_SIZE = 1024
+
+@functools.lru_cache(maxsize=ADSR_CACHE_SIZE)
+def _cached_ADSR_envelope(length, A, D, S, R, sr, dtype):
+    envelope = _ADSR_from_length(length, A, D, S, R, sr).astype(dtype)
+    envelope.flags.writeable = False
+    return envelope
+
+def ADSR_envelope(duration:float, A:float=0.04, D:float=0.06, S:float=0.6, R:float=0.05, sr:int=44100, dtype=np.float64):
+    """
+    Cached version of build_ADSR_envelope for note streams that repeat a few envelopes.
+
+    Entries are keyed by the sustained length int(duration*sr), the same number ADSR_length
+    lays the note out with, so durations like 0.1*3 and 0.3 share an entry only when they
+    cover the same samples. The envelope is built in float64 and stored as dtype.
+    The returned array is read-only, copy it before modifying it in place.
+    """
+    return _cached_ADSR_envelope(int(duration*sr), *(float(p) for p in (A, D, S, R)), int(sr), np.dtype(dtype))
+
+# hits, misses, maxsize and currsize of the envelope cache
+def ADSR_cache_info():
+    return _cached_ADSR_envelope.cache_info()
+
+def ADSR_cache_clear():
+    _cached_ADSR_envelope.cache_clear()
+
+@functools.lru_cache(maxsize=ADSR_CACHE_SIZE)
+def _ADSR_time(duration, sr):
+    t = np.arange(0, duration, 1.0/sr)
+    t.flags.writeable = False
+    return t
+
+def ADSR_envelope_slice(duration:float, start:int, length:int, A:float=0.04, D:float=0.06, S:float=0.6, R:float=0.05, sr:int=44100, dtype=np.float64):
+    """
+    Samples start to start+length of ADSR_envelope(duration, ...), the same values computed
+    for just that range, so rendering a long note block by block costs the same per block.
+    """
+    sustain = int(duration*sr)
+    t = _ADSR_time(max(A, D, R), int(sr))
+    n_A = len(t[0:num_samples(A, sr)]) if A > 0 else 0
+    n_D = len(t[0:num_samples(D, sr)]) if D > 0 else 0
+    n_R = len(t[0:num_samples(R, sr)]) if R > 0 else 0
+    attack_end = min(n_A, sustain)
+    decay_end = min(n_A + n_D, sustain)
+
+    def ADS(lo, hi):
+        x = np.full(hi - lo, float(S))
+        a = min(hi, attack_end)
+        if a > lo:
+            x[0:a-lo] = t[lo:a] / A
+        d_lo, d_hi = max(lo, attack_end), min(hi, decay_end)
+        if d_hi > d_lo:
+            x[d_lo-lo:d_hi-lo] = 1 - ((1-S)/D)*t[d_lo-n_A:d_hi-n_A]
+        return x
+
+    end = min(start + length, sustain + n_R)
+    out = np.zeros(max(end - start, 0))
+    if min(end, sustain) > start:
+        out[0:min(end, sustain)-start] = ADS(start, min(end, sustain))
+    lo = max(start, sustain)
+    if end > lo:
+        last = ADS(sustain-1, sustain)[0]
+        out[lo-start:end-start] = -last/R*t[lo-sustain:end-sustain] + last
+    return out.astype(dtype, copy=False)
+
+# number of samples ADSR_envelope produces for a note, without building it
+def ADSR_length(duration:float, R:float=0.05, sr:int=44100) -> int:
+    return int(duration*sr) + num_samples(R, sr)
+
+# events shorter than one sample (e.g. a MIDI note_on and note_off on the same tick) are
+# played for one sample, an envelope needs at least one sustained sample to release from
+def event_duration(duration:float, sr:int=44100) -> float:
+    return duration if int(duration*sr) >= 1 else 1.5/sr
+
+# largest difference between a float32 and a float64 render, relative to amp. The float32 path
+# measures around 3e-7 (tables and envelopes are built in float64 and rounded once, the phase is
+# always float64), well under the 3e-5 step of a 16-bit WAV
+FLOAT32_MAX_ERROR = 1e-6
+
+# voice generators, each renders length samples of one note at freq and returns them
+def hrm_voice(freq:float, amp:float, length:int, k:int=8, sr:int=44100, dtype=np.float64, start:int=0):
+    return wavetable_oscillator("hrm", freq, amp, length, k=k, sr=sr, dtype=dtype, start=start)
+
+# sine and triangle play the nearest MIDI pitch below freq, the harmonic voice plays freq itself
+def sin_voice(freq:float, amp:float, length:int, k:int=8, sr:int=44100, dtype=np.float64, start:int=0):
+    return wavetable_oscillator("sin", midi2freq(freq2midi(freq)), amp, length, sr=sr, dtype=dtype, start=start)
+
+def tri_voice(freq:float, amp:float, length:int, k:int=8, sr:int=44100, dtype=np.float64, start:int=0):
+    return wavetable_oscillator("tri", midi2freq(freq2midi(freq)), amp, length, k=1000, sr=sr, dtype=dtype, start=start)
+
+VOICES = {"hrm": hrm_voice, "sin": sin_voice, "tri": tri_voice}
+
+def register_voice(name:str, generator):
+    """
+    Make a voice available to render_voices under name.
+
+    generator is called as generator(freq, amp, length, k=k, sr=sr, dtype=dtype) for every
+    non-rest note and must return an array of length samples, preferably of that dtype.
+    A generator that also takes start=i (render the note from its sample i on) can be played
+    in realtime a block at a time, others are rendered whole when the note starts.
+    Registering an existing name replaces it.
+    """
+    VOICES[name] = generator
+
+def render_voices(notes, voices=("hrm", "sin", "tri"), k=8, amp=1.0, sr=44100, A=0.04, D=0.06, S=0.6, R=0.05, cache=None, dtype=np.float64):
+    """
+    Render a sequence of notes with only the voices asked for.
+
+    Args:
+        notes: List of [frequency, duration_seconds] pairs, frequency 0 is a rest
+        voices: Names of the voices to render, see VOICES and register_voice
+        k, amp, sr, A, D, S, R: Same as generate_signals
+        cache: Optional RenderCache, cached results come back as read-only memory-mapped arrays
+        dtype: Sample type of every buffer, np.float32 halves memory and bandwidth (see FLOAT32_MAX_ERROR)
+
+    Returns:
+        Dictionary mapping each voice name to its rendered signal
+    """
+    for v in voices:
+        if v not in VOICES:
+            raise Exception("unknown voice '{}'".format(v))
+
+    if cache is not None:
+        return cache.render_voices(notes, voices, k=k, amp=amp, sr=sr, A=A, D=D, S=S, R=R, dtype=dtype)
+
+    # every note occupies its envelope length back to back, so the whole layout is known up front
+    lengths = [ADSR_length(note[1], R, sr) for note in notes]
+    offsets = np.cumsum([0] + lengths)
+
+    out = {v: np.zeros(offsets[-1], dtype=dtype) for v in voices}
+    for note, start, ADSR_len in zip(notes, offsets, lengths):
+
+        # rests are left as the zeros the buffers were allocated with
+        f_i = note[0]
+        if f_i == 0:
+            continue
+
+        with stage("envelope"):
+            r_ADSR = ADSR_envelope(note[1], A, D, S, R, sr=sr, dtype=dtype)
+        end = start + ADSR_len
+        for v in voices:
+            with stage("oscillators", ADSR_len):
+                signal = VOICES[v](f_i, amp, ADSR_len, k=k, sr=sr, dtype=dtype)
+            with stage("mix", ADSR_len):
+                np.multiply(signal, r_ADSR, out=out[v][start:end])
+
+    return out
+
+BLOCK_SIZE = 8192
+
+def render_blocks(notes, voices=("hrm", "sin", "tri"), block_size=BLOCK_SIZE, k=8, amp=1.0, sr=44100, A=0.04, D=0.06, S=0.6, R=0.05, dtype=np.float64):
+    """
+    Render a note stream as fixed-size blocks instead of whole signals.
 
-def generate_signals(notes, k=8, amp=1.0, sr=44100, A=0.04, D=0.06, S=0.6, R=0.05):
+    notes can be any iterable, including a generator that is still producing notes, and
+    is only consumed as far as needed to fill the next block. Memory use is bounded by
+    the block size and the longest single note, not by the length of the stream.
 
-    hrm = sin = tri = np.array([])
+    Yields:
+        Dictionary mapping each voice name to a block of block_size samples, the last
+        block is shorter. Blocks are new arrays, the caller may keep them.
+    """
+    for v in voices:
+        if v not in VOICES:
+            raise Exception("unknown voice '{}'".format(v))
+
+    blocks = {v: np.zeros(block_size, dtype=dtype) for v in voices}
+    fill = 0
     for note in notes:
 
-        ADSR = generate_ADSR_envelope(note[1], A, D, S, R, sr=sr)
-        ADSR_len = len(ADSR)
-        ADSR_duration = ADSR_len / sr
-
-        hrm_signal = 0*ADSR
-        sin_signal = 0*ADSR
-        tri_signal = 0*ADSR
-        for f_i in [note[0]]:
-            if f_i != 0:
-                h = k_harmonics(k=k, amp=amp, freq=f_i, duration=ADSR_duration, sr=sr)
-                s = generate_sine(note_num=freq2midi(f_i), amp=amp, duration=ADSR_duration, sr=sr)
-                t = generate_triangle(note_num=freq2midi(f_i), amp=amp, duration=ADSR_duration, num_sinusoids=1000, sr=sr)
-                while len(hrm_signal) < len(h):
-                    hrm_signal = np.append(hrm_signal, [0])
-                while len(sin_signal) < len(s):
-                    sin_signal = np.append(sin_signal, [0])
-                while len(tri_signal) < len(t):
-                    tri_signal = np.append(tri_signal, [0])
-                hrm_signal = np.add(hrm_signal, h)
-                sin_signal = np.add(sin_signal, s)
-                tri_signal = np.add(tri_signal, t)
+        ADSR_len = ADSR_length(note[1], R, sr)
+        signals = None
+        if note[0] != 0:
+            with stage("envelope"):
+                r_ADSR = ADSR_envelope(note[1], A, D, S, R, sr=sr, dtype=dtype)
+            with stage("oscillators", ADSR_len * len(voices)):
+                signals = {v: VOICES[v](note[0], amp, ADSR_len, k=k, sr=sr, dtype=dtype) * r_ADSR for v in voices}
+
+        # a note can finish the current block and spill over several more
+        pos = 0
+        while pos < ADSR_len:
+            n = min(block_size - fill, ADSR_len - pos)
+            if signals is not None:
+                for v in voices:
+                    blocks[v][fill:fill+n] = signals[v][pos:pos+n]
+            fill += n
+            pos += n
+            if fill == block_size:
+                yield blocks
+                blocks = {v: np.zeros(block_size, dtype=dtype) for v in voices}
+                fill = 0
+
+    if fill > 0:
+        yield {v: blocks[v][0:fill] for v in voices}
+
+def write_blocks(blocks, files:dict, sr:int=44100, workers=None, channels:int=1, **options) -> int:
+    """
+    Append every block to its voice's file as it arrives, through an ExportWriter per voice.
+    With several files and cores the voices of a block are written in parallel threads while
+    the next block is being rendered (workers threads, by default one per file up to the
+    number of cores).
+
+    Args:
+        blocks: Iterable of dictionaries mapping voice name to samples, e.g. render_blocks
+        files: Dictionary mapping voice name to output file name
+        sr: Sample rate
+        channels: Channels of every file, blocks are then (samples, channels) frames
+        options: ExportWriter options (sr_out, bits, format, limit, dither), normalize needs
+                 the whole signal and only works with export_signals
+
+    Returns:
+        Number of samples written per file, at sr
+    """
+    if options.pop("normalize", None):
+        raise Exception("normalize needs the whole signal, use export_signals")
+    written = 0
+    outputs = {}
+    pool = None
+    try:
+        for seed, (v, file_name) in enumerate(files.items()):
+            outputs[v] = ExportWriter(file_name, sr, channels=channels, seed=seed, **options)
+        # handing every block to a thread only pays off when the threads get cores of their own
+        workers = workers or min(len(outputs), os.cpu_count() or 1)
+        if len(outputs) > 1 and workers > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            pool = ThreadPoolExecutor(max_workers=workers)
+        pending = [] # writes of the previous block, each file takes its blocks in order
+        for block in blocks:
+            block_len = len(next(iter(block.values())))
+            with stage("wav write", block_len * len(outputs)):
+                if pool is not None:
+                    for future in pending:
+                        future.result()
+                    pending = [pool.submit(outputs[v].write, block[v]) for v in outputs]
+                else:
+                    for v, f in outputs.items():
+                        f.write(block[v])
+            written += block_len
+        for future in pending:
+            future.result()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        for f in outputs.values():
+            f.close()
+    return written
+
+def stream_to_wav(notes, files:dict, block_size=BLOCK_SIZE, k=8, amp=1.0, sr=44100, A=0.04, D=0.06, S=0.6, R=0.05, dtype=np.float64, **options) -> int:
+    """
+    Render a note stream straight to WAV files, one per voice, in bounded memory.
+
+    files maps each voice to render to its output file name, options are passed on to
+    write_blocks. Returns the number of samples written per file.
+    """
+    blocks = render_blocks(notes, tuple(files), block_size, k=k, amp=amp, sr=sr, A=A, D=D, S=S, R=R, dtype=dtype)
+    return write_blocks(blocks, files, sr, **options)
+
+def notes_to_events(notes, voice="hrm", velocity=1.0, R=0.05, sr=44100):
+    """
+    Turn a sequential note list into events laid out the way render_voices plays them,
+    each note starting where the previous one's release ends.
+
+    Returns:
+        List of (onset_seconds, duration_seconds, frequency, velocity, voice) events, rests are dropped
+    """
+    events = []
+    start = 0
+    for note in notes:
+        if note[0] != 0:
+            events.append((start/sr, note[1], note[0], velocity, voice))
+        start += ADSR_length(note[1], R, sr)
+    return events
+
+def render_events(events, k=8, amp=1.0, sr=44100, A=0.04, D=0.06, S=0.6, R=0.05, dtype=np.float64):
+    """
+    Mix events that may overlap (chords, release tails running into the next note) into one buffer.
+
+    Args:
+        events: Iterable of (onset_seconds, duration_seconds, frequency, velocity, voice) tuples,
+                velocity scales amp and voice is a name from VOICES
+        k, amp, sr, A, D, S, R: Same as generate_signals
+
+    Returns:
+        The mixed signal, long enough for the last release to finish
+    """
+    events = sorted(events, key=lambda e: e[0])
+    starts = [int(round(e[0]*sr)) for e in events]
+    lengths = [ADSR_length(event_duration(e[1], sr), R, sr) for e in events]
+    out = np.zeros(max([s + n for s, n in zip(starts, lengths)], default=0), dtype=dtype)
+
+    for (onset, duration, freq, velocity, voice), start, length in zip(events, starts, lengths):
+        if freq == 0:
+            continue
+        duration = event_duration(duration, sr)
+        signal = VOICES[voice](freq, amp*velocity, length, k=k, sr=sr, dtype=dtype)
+        signal *= ADSR_envelope(duration, A, D, S, R, sr=sr, dtype=dtype)
+        out[start:start+length] += signal
+
+    return out
+
+def render_event_blocks(events, block_size=BLOCK_SIZE, k=8, amp=1.0, sr=44100, A=0.04, D=0.06, S=0.6, R=0.05, dtype=np.float64, voices=None):
+    """
+    Block by block version of render_events for long or unbounded event streams.
+
+    events must already be sorted by onset when given as a generator (lists are sorted
+    here). Each event is synthesized once when the block it starts in is reached and is
+    dropped as soon as its release has been mixed, so every block only touches the
+    events that sound during it. With voices every event is played by each of those voices
+    instead of its own, so one pass over the events renders them all.
+
+    Yields:
+        Mixed blocks of block_size samples, the last one ends with the last release. With
+        voices, dictionaries mapping each voice name to its block (like render_blocks),
+        every voice's blocks have the same length
+    """
+    names = tuple(voices) if voices is not None else (None,)
+    for v in names:
+        if v is not None and v not in VOICES:
+            raise Exception("unknown voice '{}'".format(v))
+    if isinstance(events, list):
+        events = sorted(events, key=lambda e: e[0])
+    events = iter(events)
+
+    active = [] # [start sample, length, {voice: signal}] of every event still sounding
+    pending = next(events, None)
+    block_start = 0
+    stream_end = 0
+    while pending is not None or active:
+        block_end = block_start + block_size
+
+        # start every event that begins before the end of this block
+        while pending is not None and int(round(pending[0]*sr)) < block_end:
+            onset, duration, freq, velocity, voice = pending
+            if freq != 0:
+                duration = event_duration(duration, sr)
+                length = ADSR_length(duration, R, sr)
+                envelope = ADSR_envelope(duration, A, D, S, R, sr=sr, dtype=dtype)
+                signals = {}
+                for v in names:
+                    signals[v] = VOICES[v or voice](freq, amp*velocity, length, k=k, sr=sr, dtype=dtype)
+                    signals[v] *= envelope
+                active.append([int(round(onset*sr)), length, signals])
+                stream_end = max(stream_end, active[-1][0] + length)
+            pending = next(events, None)
+
+        blocks = {v: np.zeros(block_size, dtype=dtype) for v in names}
+        still_active = []
+        for start, length, signals in active:
+            lo = max(start, block_start)
+            hi = min(start + length, block_end)
+            if hi > lo:
+                for v in names:
+                    blocks[v][lo-block_start:hi-block_start] += signals[v][lo-start:hi-start]
+            if start + length > block_end:
+                still_active.append([start, length, signals])
+        active = still_active
+
+        # the final block stops where the last release ends
+        size = block_size
+        if pending is None and not active:
+            size = max(stream_end - block_start, 0)
+        if size > 0:
+            yield {v: blocks[v][0:size] for v in names} if voices is not None else blocks[None][0:size]
+        block_start = block_end
+
+def generate_signals(notes, k=8, amp=1.0, sr=44100, A=0.04, D=0.06, S=0.6, R=0.05, cache=None, dtype=np.float64):
+    out = render_voices(notes, ("hrm", "sin", "tri"), k=k, amp=amp, sr=sr, A=A, D=D, S=S, R=R, cache=cache, dtype=dtype)
+    return [out["hrm"], out["sin"], out["tri"], notes]
+
+CHANNEL_LAYOUTS = ["split", "multi", "stereo"] # a file per voice, a channel per voice, a stereo mix
+STEREO_SPREAD = 0.5 # default pans run from -spread (left) to spread (right) across the voices
+
+def pan_gains(pan:float):
+    # constant power (left, right) gains for a pan from -1 (left) to 1 (right)
+    angle = (min(max(pan, -1.0), 1.0) + 1) * np.pi / 4
+    return np.cos(angle), np.sin(angle)
+
+def default_pans(voices, spread:float=STEREO_SPREAD) -> dict:
+    # voices spread evenly from left to right in the order given, a single voice is centred
+    pans = np.linspace(-spread, spread, len(voices)) if len(voices) > 1 else [0.0]*len(voices)
+    return {v: float(p) for v, p in zip(voices, pans)}
+
+def render_channels(notes, voices=("hrm", "sin", "tri"), pan=None, gain=None, k=8, amp=1.0, sr=44100, A=0.04, D=0.06, S=0.6, R=0.05, dtype=np.float64):
+    """
+    Render the voices straight into one preallocated (samples, channels) array, written with
+    a single multichannel file instead of a file per voice.
+
+    Args:
+        notes, voices, k, amp, sr, A, D, S, R, dtype: Same as render_voices
+        pan: None for one channel per voice in the order of voices (the same samples as
+             render_voices), or a dictionary mapping voice name to a pan from -1 (left) to
+             1 (right) for a constant power stereo mix, voices missing from it are centred
+        gain: Optional dictionary mapping voice name to its gain, 1.0 for the rest
+
+    Returns:
+        Array of shape (samples, len(voices)), or (samples, 2) with pan
+    """
+    for v in voices:
+        if v not in VOICES:
+            raise Exception("unknown voice '{}'".format(v))
+
+    gains, mix = _channel_mix(voices, pan, gain)
+
+    lengths = [ADSR_length(note[1], R, sr) for note in notes]
+    offsets = np.cumsum([0] + lengths)
+
+    out = np.zeros((offsets[-1], len(voices) if mix is None else 2), dtype=dtype)
+    for note, start, ADSR_len in zip(notes, offsets, lengths):
+
+        # rests are left as the zeros the buffer was allocated with
+        f_i = note[0]
+        if f_i == 0:
+            continue
+
+        with stage("envelope"):
+            r_ADSR = ADSR_envelope(note[1], A, D, S, R, sr=sr, dtype=dtype)
+        frames = out[start:start+ADSR_len]
+        for i, v in enumerate(voices):
+            with stage("oscillators", ADSR_len):
+                signal = VOICES[v](f_i, amp, ADSR_len, k=k, sr=sr, dtype=dtype)
+            with stage("mix", ADSR_len):
+                if mix is None:
+                    np.multiply(signal, r_ADSR, out=frames[:, i])
+                    if gains[i] != 1.0:
+                        frames[:, i] *= gains[i]
+                else:
+                    signal = signal * r_ADSR
+                    frames[:, 0] += (gains[i] * mix[i][0]) * signal
+                    frames[:, 1] += (gains[i] * mix[i][1]) * signal
+
+    return out
+
+# channels of what render_channels or channel_blocks produce with these options
+def channel_count(voices=("hrm", "sin", "tri"), pan=None, gain=None) -> int:
+    return len(voices) if pan is None else 2
+
+# per voice gains and, with pan, the (left, right) gains of each voice
+def _channel_mix(voices, pan, gain):
+    gains = [(gain or {}).get(v, 1.0) for v in voices]
+    mix = None if pan is None else [pan_gains(pan.get(v, 0.0)) for v in voices]
+    return gains, mix
+
+def channel_blocks(blocks, voices=("hrm", "sin", "tri"), pan=None, gain=None, dtype=np.float64):
+    """
+    Block by block version of render_channels: mixes the voice blocks of render_blocks (or any
+    dictionaries of equally long voice blocks) into frames laid out the same way.
+
+    Yields:
+        Arrays of shape (block samples, len(voices)), or (block samples, 2) with pan
+    """
+    gains, mix = _channel_mix(voices, pan, gain)
+    for block in blocks:
+        n = len(block[voices[0]]) if voices else 0
+        frames = np.zeros((n, len(voices) if mix is None else 2), dtype=dtype)
+        with stage("mix", frames.size):
+            for i, v in enumerate(voices):
+                if mix is None:
+                    frames[:, i] = block[v]
+                    if gains[i] != 1.0:
+                        frames[:, i] *= gains[i]
+                else:
+                    frames[:, 0] += (gains[i] * mix[i][0]) * block[v]
+                    frames[:, 1] += (gains[i] * mix[i][1]) * block[v]
+        yield frames
+
+def add_channel_args(parser):
+    parser.add_argument("--channels", choices=CHANNEL_LAYOUTS, default="split", help="a file per voice, one file with a channel per voice, or one stereo mix")
+    parser.add_argument("--pan", nargs="+", default=[], metavar="VOICE=PAN", help="stereo position of a voice, -1 (left) to 1 (right), e.g. sin=-0.8")
+    parser.add_argument("--gain", nargs="+", default=[], metavar="VOICE=GAIN", help="gain of a voice in the multi and stereo layouts")
+
+def _voice_values(pairs) -> dict:
+    values = {}
+    for pair in pairs:
+        v, sep, value = pair.partition("=")
+        if not sep:
+            raise Exception("expected VOICE=VALUE, got '{}'".format(pair))
+        values[v] = float(value)
+    return values
+
+# keyword arguments for render_channels from the add_channel_args flags, None for the split layout
+def channel_options_from_args(args, voices=("hrm", "sin", "tri")):
+    if args.channels == "split":
+        return None
+    options = {"voices": tuple(voices), "gain": _voice_values(args.gain)}
+    if args.channels == "stereo":
+        options["pan"] = {**default_pans(voices), **_voice_values(args.pan)}
+    return options
+
+RENDER_CACHE_DIR = "sg_cache/"
+RENDER_CACHE_MAX_BYTES = 2 * 2**30
+RENDER_CACHE_VERSION = 2 # bump when synthesis changes so old entries stop matching
+
+class RenderCache:
+    """
+    Content-addressed on-disk cache of rendered voices, used through render_voices(..., cache=...).
+
+    Whole streams are keyed by a hash of the note list, the voice (and the generator registered
+    for it) and every synthesis parameter, so rerunning a script on unchanged input just maps
+    the stored .npy files back in. Every distinct note is cached on its own as well, so a stream
+    that was partly edited only synthesizes the notes that are new. Once the directory grows
+    past max_bytes the least recently used files are deleted, and an entry bigger than max_bytes
+    on its own is never written.
+    """
+    def __init__(self, cache_dir:str=RENDER_CACHE_DIR, max_bytes:int=RENDER_CACHE_MAX_BYTES, max_notes_in_memory:int=4096):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_notes_in_memory = max_notes_in_memory
+        self.notes = {} # note key -> rendered note, in least to most recently used order
+        self.stats = {"stream_hits": 0, "stream_misses": 0, "note_hits": 0, "note_misses": 0, "evicted": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(size for path, size, mtime in self.entries())
+
+    # (path, size, mtime) of every finished entry, several processes may be adding and
+    # evicting entries in the same directory at once
+    def entries(self) -> list:
+        entries = []
+        for e in os.scandir(self.cache_dir):
+            if e.name.endswith(".npy") and not e.name.endswith(".tmp.npy"):
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((e.path, st.st_size, st.st_mtime))
+        return entries
+
+    def key(self, kind:str, voice:str, params:tuple, data:bytes) -> str:
+        generator = VOICES[voice]
+        h = hashlib.sha256()
+        h.update(repr((RENDER_CACHE_VERSION, kind, voice, generator.__module__, generator.__qualname__, params)).encode())
+        h.update(data)
+        return kind + "_" + h.hexdigest()
+
+    def path(self, key:str) -> str:
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def load(self, key:str, mmap:bool=True):
+        path = self.path(key)
+        try:
+            array = np.load(path, mmap_mode="r" if mmap else None)
+            os.utime(path) # mark as recently used
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        return array
+
+    def store(self, key:str, array):
+        # write under a name private to this process first so a crash never leaves a truncated
+        # entry behind and two processes storing the same key don't trip over each other
+        if array.nbytes > self.max_bytes: # would only be evicted again straight away
+            return
+        path = self.path(key)
+        tmp_path = path[:-4] + ".{}.tmp.npy".format(os.getpid())
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path)
+        self.total_bytes += array.nbytes
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        self.total_bytes = sum(size for path, size, mtime in entries)
+        for path, size, mtime in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError: # another process got to it first
+                pass
+            except OSError: # still mapped somewhere (Windows), try again next time
+                continue
+            self.total_bytes -= size
+            self.stats["evicted"] += 1
+
+    def clear(self):
+        for path, size, mtime in self.entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.notes.clear()
+        self.total_bytes = 0
+
+    def note(self, voice:str, freq:float, duration:float, length:int, k, amp, sr, A, D, S, R, dtype=np.float64):
+        params = (k, amp, sr, A, D, S, R, np.dtype(dtype).str)
+        key = self.key("note", voice, params, repr((float(freq), float(duration))).encode())
+        signal = self.notes.pop(key, None)
+        if signal is None:
+            signal = self.load(key, mmap=False)
+        if signal is None:
+            self.stats["note_misses"] += 1
+            with stage("oscillators", length):
+                signal = VOICES[voice](freq, amp, length, k=k, sr=sr, dtype=dtype)
+            with stage("envelope"):
+                signal *= ADSR_envelope(duration, A, D, S, R, sr=sr, dtype=dtype)
+            self.store(key, signal)
+        else:
+            self.stats["note_hits"] += 1
+        self.notes[key] = signal
+        if len(self.notes) > self.max_notes_in_memory:
+            del self.notes[next(iter(self.notes))]
+        return signal
+
+    def render_voices(self, notes, voices, k=8, amp=1.0, sr=44100, A=0.04, D=0.06, S=0.6, R=0.05, dtype=np.float64):
+        params = (k, amp, sr, A, D, S, R, np.dtype(dtype).str)
+        note_data = np.array([[note[0], note[1]] for note in notes], dtype=np.float64).tobytes()
+
+        out = {}
+        missing = []
+        for v in voices:
+            key = self.key("stream", v, params, note_data)
+            cached = self.load(key)
+            if cached is None:
+                missing.append((v, key))
             else:
-                s = 0.0*np.arange(0, ADSR_duration, 1.0/sr)
-                while len(sin_signal) < len(s):
-                    sin_signal = np.append(sin_signal, [0])
-                hrm_signal = np.add(sin_signal, s)
-                sin_signal = np.add(sin_signal, s)
-                tri_signal = np.add(sin_signal, s)
+                out[v] = cached
+                self.stats["stream_hits"] += 1
+
+        if missing:
+            lengths = [ADSR_length(note[1], R, sr) for note in notes]
+            offsets = np.cumsum([0] + lengths)
+            for v, key in missing:
+                self.stats["stream_misses"] += 1
+                signal = np.zeros(offsets[-1], dtype=dtype)
+                for note, start, ADSR_len in zip(notes, offsets, lengths):
+                    if note[0] != 0:
+                        with stage("mix", ADSR_len):
+                            signal[start:start+ADSR_len] = self.note(v, note[0], note[1], ADSR_len, k, amp, sr, A, D, S, R, dtype)
+                self.store(key, signal)
+                out[v] = signal
+
+        return out
+
+class IncrementalRenderer:
+    """
+    Re-renders an edited note stream by synthesizing only the notes that changed.
+
+    Every note of render_voices owns ADSR_length samples back to back, so the note list is an
+    index of sample offsets into the output. render diffs a new note list against the previous
+    one (common prefix and suffix first, difflib on what is left) and re-synthesizes only the
+    inserted or replaced notes.
+
+    files maps each voice to a WAV file that holds its output, and the note list is saved next
+    to them (index_file) so the next run can pick up where this one stopped. When no note
+    changes length the changed notes are patched into the WAV files in place. Otherwise the
+    output is rewritten from the first change on, shifting what follows, and nothing before the
+    change is touched. With files=None the output is kept in memory instead (see signals).
+
+    Written samples go through the same peak limiter (limit, the EXPORT_LIMIT default) and
+    dithered conversion to bits as ExportWriter, a segment at a time. Segments always hold
+    whole notes, so each can be limited on its own, and notes moved by a shift are copied
+    sample for sample rather than dithered again. The files are patched in place, so they
+    have to be WAV at the render rate, format, sr_out and normalize are only accepted so that
+    export_signals options can be passed on unchanged.
+    """
+    def __init__(self, files=None, index_file=None, voices=("hrm", "sin", "tri"), k=8, amp=1.0, sr=44100, A=0.04, D=0.06, S=0.6, R=0.05, dtype=np.float64,
+                 bits:int=16, limit=1.0, dither:bool=True, seed:int=0, format=None, sr_out=None, normalize=None):
+        if format not in (None, "wav") or sr_out not in (None, sr) or normalize:
+            raise Exception("the incremental renderer patches WAV files at the render rate in place, it can't change format or rate or normalize")
+        if files is not None and any(os.path.splitext(f)[1].lower() != ".wav" for f in files.values()):
+            raise Exception("the incremental renderer only writes WAV files")
+        if bits not in EXPORT_SUBTYPES:
+            raise Exception("bits must be one of {}".format(sorted(EXPORT_SUBTYPES)))
+        self.files = files
+        self.voices = tuple(files) if files is not None else tuple(voices)
+        self.index_file = index_file
+        self.render_args = dict(k=k, amp=amp, sr=sr, A=A, D=D, S=S, R=R, dtype=dtype)
+        self.export = dict(bits=bits, limit=limit or None, dither=dither)
+        self.rng = np.random.default_rng(seed) if dither and bits != 32 else None
+        self.params = repr((RENDER_CACHE_VERSION, [(v, self.files and self.files[v], VOICES[v].__qualname__) for v in self.voices],
+                            k, float(amp), sr, float(A), float(D), float(S), float(R), np.dtype(dtype).str, bits, limit or None, bool(dither)))
+        self.notes = None # (N, 2) float64 array of the last render
+        self.buffers = {} # voice -> signal, when there are no files
+        self.stats = {}
+        if index_file is not None and files is not None:
+            self.notes = self.load_index()
+
+    def load_index(self):
+        try:
+            with np.load(self.index_file) as index:
+                if str(index["params"]) != self.params:
+                    return None
+                notes = index["notes"]
+            # the files have to still be the ones the index describes
+            total = int(self.lengths(notes).sum())
+            for v, file_name in self.files.items():
+                if sf.info(file_name).frames != total:
+                    return None
+            return notes
+        except (FileNotFoundError, OSError, KeyError, ValueError, RuntimeError):
+            return None
+
+    def save_index(self):
+        if self.index_file is not None:
+            with open(self.index_file, "wb") as f: # np.savez would append .npz to the name
+                np.savez(f, notes=self.notes, params=np.array(self.params))
+
+    def lengths(self, notes):
+        R, sr = self.render_args["R"], self.render_args["sr"]
+        return np.array([ADSR_length(d, R, sr) for d in notes[:, 1].tolist()], dtype=np.int64)
+
+    def synthesize(self, notes):
+        return render_voices(notes.tolist(), self.voices, **self.render_args)
+
+    def signals(self) -> dict:
+        """
+        The current output of every voice (read back from the WAV files when there are any).
+        """
+        if self.files is None:
+            return self.buffers
+        return {v: sf.read(file_name, dtype=self.render_args["dtype"])[0] for v, file_name in self.files.items()}
+
+    def raw_dtype(self):
+        # how samples are read from and written to the files unchanged, PCM as full scale int32
+        return "float32" if self.export["bits"] == 32 else "int32"
+
+    def encode(self, segment):
+        # limit and quantize a segment for the files as ExportWriter would, in raw_dtype
+        if self.export["limit"]:
+            limiter = PeakLimiter(self.export["limit"])
+            segment = np.concatenate((limiter.process(segment), limiter.flush()))
+        if self.export["bits"] == 32:
+            return segment.astype(np.float32)
+        q = dither_to_int(segment, self.export["bits"], self.rng)
+        return q.astype(np.int32) << 16 if self.export["bits"] == 16 else q
+
+    def write(self, offset:int, segments:dict, total=None, encoded:bool=False):
+        # put segments at sample offset, then cut the output to total samples if given. encoded
+        # segments are already in raw_dtype (e.g. unchanged notes read back from the files)
+        for v in self.voices:
+            if self.files is None:
+                if total is not None:
+                    buf = np.zeros(total, dtype=self.render_args["dtype"])
+                    if offset > 0:
+                        buf[0:offset] = self.buffers[v][0:offset]
+                    self.buffers[v] = buf
+                self.buffers[v][offset:offset+len(segments[v])] = segments[v]
+            elif total is not None and offset == 0 and not encoded:
+                with ExportWriter(self.files[v], self.render_args["sr"], seed=int(self.rng.integers(1 << 31)) if self.rng else 0, **self.export) as f:
+                    f.write(segments[v])
+            else:
+                with sf.SoundFile(self.files[v], "r+") as f:
+                    f.seek(offset)
+                    f.write(segments[v] if encoded else self.encode(segments[v]))
+                    if total is not None:
+                        f.truncate(total)
+
+    def read(self, start:int, stop:int) -> dict:
+        # samples start to stop of every voice, from the files in raw_dtype
+        if self.files is None:
+            return {v: self.buffers[v][start:stop].copy() for v in self.voices}
+        out = {}
+        for v, file_name in self.files.items():
+            with sf.SoundFile(file_name) as f:
+                f.seek(start)
+                out[v] = f.read(stop - start, dtype=self.raw_dtype())
+        return out
+
+    def render(self, notes) -> dict:
+        """
+        Bring the output up to date with notes ([frequency, duration_seconds] pairs).
+
+        Returns:
+            stats of the update: mode ("full", "patch", "shift" or "unchanged"), the number
+            of notes synthesized and the number of samples written
+        """
+        new = np.array([(float(n[0]), float(n[1])) for n in notes], dtype=np.float64).reshape(-1, 2)
+        new_lengths = self.lengths(new)
+        new_offsets = np.concatenate(([0], np.cumsum(new_lengths)))
+        total = int(new_offsets[-1])
+
+        if self.notes is None:
+            with stage("incremental render", total):
+                self.write(0, self.synthesize(new), total)
+            self.notes = new
+            self.save_index()
+            self.stats = {"mode": "full", "notes_rendered": len(new), "samples_written": total}
+            return self.stats
+
+        old = self.notes
+        old_lengths = self.lengths(old)
+        old_offsets = np.concatenate(([0], np.cumsum(old_lengths)))
+
+        # common prefix and suffix, compared as arrays
+        m = min(len(old), len(new))
+        differ = np.flatnonzero((old[0:m] != new[0:m]).any(axis=1))
+        p = int(differ[0]) if len(differ) else m
+        differ = np.flatnonzero((old[len(old)-(m-p):] != new[len(new)-(m-p):]).any(axis=1)[::-1]) if m > p else []
+        s = int(differ[0]) if len(differ) else m - p
+
+        if p == len(old) == len(new):
+            self.stats = {"mode": "unchanged", "notes_rendered": 0, "samples_written": 0}
+            return self.stats
+
+        # what's left in the middle is matched note by note, equal runs are copied not rendered
+        import difflib
+        old_mid = [tuple(n) for n in old[p:len(old)-s].tolist()]
+        new_mid = [tuple(n) for n in new[p:len(new)-s].tolist()]
+        opcodes = [(tag, i1+p, i2+p, j1+p, j2+p) for tag, i1, i2, j1, j2 in
+                   difflib.SequenceMatcher(None, old_mid, new_mid, autojunk=False).get_opcodes()]
+
+        rendered = 0
+        written = 0
+        with stage("incremental render"):
+            if total == int(old_offsets[-1]) and all(old_offsets[i1] == new_offsets[j1] for tag, i1, i2, j1, j2 in opcodes if tag == "equal"):
+                # nothing moves, patch the replaced notes where they are
+                mode = "patch"
+                for tag, i1, i2, j1, j2 in opcodes:
+                    if tag != "equal" and j2 > j1:
+                        self.write(int(new_offsets[j1]), self.synthesize(new[j1:j2]))
+                        rendered += j2 - j1
+                        written += int(new_offsets[j2] - new_offsets[j1])
+            else:
+                # rebuild everything from the first change on, unchanged notes are copied from the old output
+                mode = "shift"
+                start_old, start_new = int(old_offsets[p]), int(new_offsets[p])
+                old_tail = self.read(start_old, int(old_offsets[-1]))
+                pieces = {v: [] for v in self.voices}
+                for tag, i1, i2, j1, j2 in opcodes + [("equal", len(old)-s, len(old), len(new)-s, len(new))]:
+                    if tag == "equal":
+                        seg = {v: old_tail[v][int(old_offsets[i1])-start_old:int(old_offsets[i2])-start_old] for v in self.voices}
+                    elif j2 > j1:
+                        seg = self.synthesize(new[j1:j2])
+                        if self.files is not None:
+                            seg = {v: self.encode(seg[v]) for v in self.voices}
+                        rendered += j2 - j1
+                    else:
+                        continue
+                    for v in self.voices:
+                        pieces[v].append(seg[v])
+                dtype = self.render_args["dtype"] if self.files is None else self.raw_dtype()
+                tail = {v: np.concatenate(pieces[v]) if pieces[v] else np.zeros(0, dtype=dtype) for v in self.voices}
+                self.write(start_new, tail, total, encoded=self.files is not None)
+                written = total - start_new
+
+        self.notes = new
+        self.save_index()
+        self.stats = {"mode": mode, "notes_rendered": rendered, "samples_written": written}
+        return self.stats
+
+MIDI_TICKS_PER_BEAT = 480
+MIDI_REST = 0 # note number of a rest, freq2midi(0) == 0
+MIDI_CHUNK_BYTES = 1 << 16 # how much of a track the streaming writer buffers before writing
+
+def midi_note_events(note_list, ticks_per_second:float, velocity:int=64, rest=MIDI_REST):
+    """
+    Turn a sequential stream of (note_number, duration_seconds[, velocity]) into
+    (delta_ticks, type, note, velocity) events, ending with an "end_of_track" event.
+
+    Rests (note None or <= rest) write no events, their time is added to the next delta.
+    Tick times are rounded from the running total in seconds, so rounding errors don't
+    add up over long streams.
+    """
+    elapsed = 0.0
+    last_tick = 0
+    for n in note_list:
+        note, duration = n[0], n[1]
+        if note is None or (rest is not None and note <= rest):
+            elapsed += duration
+            continue
+        vel = n[2] if len(n) > 2 else velocity
+
+        on_tick = round(elapsed * ticks_per_second)
+        elapsed += duration
+        off_tick = round(elapsed * ticks_per_second)
+        yield on_tick - last_tick, "note_on", note, vel
+        yield off_tick - on_tick, "note_off", note, vel
+        last_tick = off_tick
+
+    # trailing rests still count towards the length of the track
+    yield round(elapsed * ticks_per_second) - last_tick, "end_of_track", 0, 0
+
+# meta events opening a track, the first track also carries the tempo and time signature
+def midi_track_meta(name, first:bool, tempo:int, time_signature):
+    meta = []
+    if name is not None:
+        meta.append(("track_name", {"name": name}))
+    if first:
+        meta.append(("set_tempo", {"tempo": tempo}))
+        meta.append(("time_signature", {"numerator": time_signature[0], "denominator": time_signature[1]}))
+    return meta
+
+def midi_varlen(value:int) -> bytes:
+    out = [value & 0x7F]
+    value >>= 7
+    while value:
+        out.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(out))
+
+def midi_meta_bytes(type:str, args:dict) -> bytes:
+    if type == "track_name":
+        data = 0x03, args["name"].encode("latin1")
+    elif type == "set_tempo":
+        data = 0x51, args["tempo"].to_bytes(3, "big")
+    elif type == "time_signature":
+        data = 0x58, bytes([args["numerator"], int(math.log2(args["denominator"])), 24, 8])
+    elif type == "end_of_track":
+        data = 0x2F, b""
+    else:
+        raise Exception("unsupported meta event '{}'".format(type))
+    return bytes([0xFF, data[0]]) + midi_varlen(len(data[1])) + data[1]
+
+def write_midi_stream(tracks:dict, output_file:str, tempo:int, time_signature, ticks_per_beat:int, rest, chunk_bytes:int=MIDI_CHUNK_BYTES):
+    """
+    Write a type 1 MIDI file event by event, without building a MidiFile. Each track's
+    length is patched into its header once the track is done, so the note lists can be
+    generators of any length. The bytes match what mido would save for the same tracks.
+    Returns the number of notes written.
+    """
+    ticks_per_second = ticks_per_beat * 1_000_000 / tempo
+    status_bytes = {"note_on": 0x90, "note_off": 0x80}
+    notes_written = 0
+
+    with open(output_file, "wb") as f:
+        f.write(b"MThd" + (6).to_bytes(4, "big") + (1).to_bytes(2, "big") + len(tracks).to_bytes(2, "big") + ticks_per_beat.to_bytes(2, "big"))
+
+        for channel, (name, note_list) in enumerate(tracks.items()):
+            f.write(b"MTrk")
+            length_at = f.tell()
+            f.write(bytes(4))
+            length = 0
+
+            data = bytearray()
+            for type, args in midi_track_meta(name, channel == 0, tempo, time_signature):
+                data += b"\x00" + midi_meta_bytes(type, args)
 
-        r_ADSR = np.array([i/100 for i in ADSR])
-        while len(r_ADSR) < len(hrm_signal):
-            r_ADSR = np.append(r_ADSR, [0])
-        hrm_signal_ADSR = np.multiply(hrm_signal, r_ADSR)[0:ADSR_len]
-        sin_signal_ADSR = np.multiply(sin_signal, r_ADSR)[0:ADSR_len]
-        tri_signal_ADSR = np.multiply(tri_signal, r_ADSR)[0:ADSR_len]
+            running_status = None
+            for delta, type, note, vel in midi_note_events(note_list, ticks_per_second, rest=rest):
+                data += midi_varlen(delta)
+                if type == "end_of_track":
+                    data += midi_meta_bytes(type, {})
+                    break
+                status = status_bytes[type] | channel
+                notes_written += type == "note_on"
+                if status != running_status:
+                    data.append(status)
+                    running_status = status
+                data.append(note)
+                data.append(vel)
 
-        hrm = np.append(hrm, hrm_signal_ADSR)
-        sin = np.append(sin, sin_signal_ADSR)
-        tri = np.append(tri, tri_signal_ADSR)
+                if len(data) >= chunk_bytes:
+                    f.write(data)
+                    length += len(data)
+                    data.clear()
 
-    return [hrm, sin, tri, notes]
+            f.write(data)
+            length += len(data)
+            end = f.tell()
+            f.seek(length_at)
+            f.write(length.to_bytes(4, "big"))
+            f.seek(end)
+    return notes_written
 
-def create_midi_from_notes(note_list, output_file='output.mid', tempo=500000, time_signature=(4, 4)):
+def create_midi_from_notes(note_list, output_file='output.mid', tempo=500000, time_signature=(4, 4),
+                           ticks_per_beat=MIDI_TICKS_PER_BEAT, rest=MIDI_REST, stream=False):
     """
     Create a MIDI file from a list of notes and durations.
 
     Args:
-        note_list: List of tuples in format (note_number, duration_seconds)
+        note_list: List of tuples in format (note_number, duration_seconds[, velocity]), or a
+                   dict of named lists (e.g. {"hrm": ..., "sin": ..., "tri": ...}) written as one
+                   track per voice, each on its own channel
         output_file: Name of the output MIDI file
         tempo: Microseconds per quarter note (default 500000 = 120 BPM)
         time_signature: Tuple of (numerator, denominator)
+        ticks_per_beat: MIDI time resolution
+        rest: Notes at or below this number are rests and only add time (None to keep them)
+        stream: Write events straight to the file instead of building a MidiFile, the
+                note lists may then be generators
+
+    Returns:
+        the MidiFile, or None when streaming
     """
-    # Create a new MIDI file and track
-    mid = MidiFile()
-    track = MidiTrack()
-    mid.tracks.append(track)
+    tracks = note_list if isinstance(note_list, dict) else {None: note_list}
+    if len(tracks) > 16:
+        raise Exception("at most 16 tracks, one per MIDI channel")
+
+    if stream:
+        with stage("midi write") as st:
+            st.add_samples(write_midi_stream(tracks, output_file, tempo, time_signature, ticks_per_beat, rest))
+        print(f"MIDI file saved as {output_file}")
+        return None
+
+    with stage("midi write") as st:
+        mid, notes_written = midi_file_from_tracks(tracks, tempo, time_signature, ticks_per_beat, rest)
+        mid.save(output_file)
+        st.add_samples(notes_written)
+    print(f"MIDI file saved as {output_file}")
+    return mid
+
+# the MidiFile create_midi_from_notes saves, and the number of notes in it
+def midi_file_from_tracks(tracks:dict, tempo:int, time_signature, ticks_per_beat:int, rest):
+    from mido import Message, MetaMessage, MidiFile, MidiTrack
 
-    # Set tempo and time signature
-    track.append(mido.MetaMessage('set_tempo', tempo=tempo))
-    track.append(mido.MetaMessage('time_signature',
-                                 numerator=time_signature[0],
-                                 denominator=time_signature[1]))
+    mid = MidiFile(ticks_per_beat=ticks_per_beat)
+    ticks_per_second = ticks_per_beat * 1_000_000 / tempo
+    notes_written = 0
 
-    # Convert seconds to ticks
+    for channel, (name, notes) in enumerate(tracks.items()):
+        track = MidiTrack()
+        mid.tracks.append(track)
+
+        for type, args in midi_track_meta(name, channel == 0, tempo, time_signature):
+            track.append(MetaMessage(type, **args))
+
+        for delta, type, note, vel in midi_note_events(notes, ticks_per_second, rest=rest):
+            if type == "end_of_track":
+                track.append(MetaMessage(type, time=delta))
+            else:
+                track.append(Message(type, channel=channel, note=note, velocity=vel, time=delta))
+                notes_written += type == "note_on"
+    return mid, notes_written
+
+def midi_file_events(file_name:str, voice=None, default_voice="hrm"):
+    """
+    Read a MIDI file back as (onset_seconds, duration_seconds, frequency, velocity, voice)
+    events sorted by onset, ready for render_events or render_event_blocks.
+
+    Tracks are merged in time order and set_tempo changes in any track apply from their
+    tick on. Notes may overlap, repeated note_ons of one pitch on one channel are closed
+    first in, first out, and notes still held at the end stop with the file. velocity is
+    the MIDI velocity / 127. voice forces one voice for every note, otherwise a track named
+    after a voice in VOICES (as create_midi_from_notes names them) plays with that voice
+    and every other track with default_voice.
+
+    Events are yielded as soon as no earlier note can still start, so long files are
+    rendered while they are read. Times are rounded to the nanosecond, so a duration written
+    from 0.25 seconds reads back as 0.25 and not 0.24999999999 (a sample short).
+    """
+    import heapq
+    import mido
+
+    mid = mido.MidiFile(file_name)
     ticks_per_beat = mid.ticks_per_beat
-    seconds_per_beat = tempo / 1_000_000  # Convert microseconds to seconds
+    voices = [voice or (track.name if track.name in VOICES else default_voice) for track in mid.tracks]
 
-    for note, duration in note_list:
-        # Note on event (velocity=64 is a moderate volume)
-        track.append(Message('note_on', note=note, velocity=64, time=0))
+    def absolute_ticks(track_num, track):
+        tick = 0
+        for msg in track:
+            tick += msg.time
+            yield tick, track_num, msg
 
-        # Calculate duration in ticks
-        duration_ticks = int((duration / seconds_per_beat) * ticks_per_beat)
+    # seconds are counted from the last tempo change so they don't drift over long files
+    tempo = 500000
+    tempo_tick = 0
+    tempo_seconds = 0.0
 
-        # Note off event after the duration
-        track.append(Message('note_off', note=note, velocity=64, time=duration_ticks))
+    held = {} # (track, channel, note) -> [(onset, velocity), ...] in note_on order
+    finished = [] # heap of (onset, order, event)
+    order = 0
+    seconds = 0.0
 
-    # Save the MIDI file
-    mid.save(output_file)
-    print(f"MIDI file saved as {output_file}")
+    for tick, track_num, msg in heapq.merge(*[absolute_ticks(i, t) for i, t in enumerate(mid.tracks)], key=lambda m: m[0]):
+        seconds = round(tempo_seconds + (tick - tempo_tick) * tempo / (1_000_000 * ticks_per_beat), 9)
+
+        if msg.type == "set_tempo":
+            tempo, tempo_tick, tempo_seconds = msg.tempo, tick, seconds
+        elif msg.type == "note_on" and msg.velocity > 0:
+            held.setdefault((track_num, msg.channel, msg.note), []).append((seconds, msg.velocity))
+        elif msg.type in ("note_on", "note_off"):
+            started = held.get((track_num, msg.channel, msg.note))
+            if not started:
+                continue # note_off without a note_on
+            onset, velocity = started.pop(0)
+            if not started:
+                del held[(track_num, msg.channel, msg.note)]
+            heapq.heappush(finished, (onset, order, (onset, round(seconds - onset, 9), midi2freq(msg.note), velocity/127, voices[track_num])))
+            order += 1
+
+            earliest_held = min((s[0][0] for s in held.values()), default=float("inf"))
+            while finished and finished[0][0] <= earliest_held:
+                yield heapq.heappop(finished)[2]
+
+    for (track_num, channel, note), started in held.items():
+        for onset, velocity in started:
+            heapq.heappush(finished, (onset, order, (onset, round(seconds - onset, 9), midi2freq(note), velocity/127, voices[track_num])))
+            order += 1
+    while finished:
+        yield heapq.heappop(finished)[2]
+
+INTEGER_CHUNK_BYTES = 1 << 22
+INTEGER_MAX_DIGITS = 18 # longer tokens might not fit in int64 and take the exact path
+
+# byte classes for the fast path: 0 anything else, 1 digit, 2 minus, 3 whitespace
+_BYTE_CLASS = np.zeros(256, dtype=np.uint8)
+_BYTE_CLASS[np.frombuffer(b"0123456789", dtype=np.uint8)] = 1
+_BYTE_CLASS[ord("-")] = 2
+_BYTE_CLASS[np.frombuffer(b" \t\n\r\f\v", dtype=np.uint8)] = 3
+
+def _parse_integer_chunk(chunk:bytes):
+    """
+    Integers of every whitespace separated token of chunk that is an optional minus and digits,
+    other tokens are skipped. Plain ASCII chunks of well formed tokens are parsed by NumPy in
+    one go, anything else (malformed or unicode tokens, huge numbers) token by token.
+    """
+    c = _BYTE_CLASS[np.frombuffer(chunk, dtype=np.uint8)]
+    fast = len(c) > 0 and not (c == 0).any()
+    if fast:
+        ws = np.concatenate(([True], c == 3, [True]))
+        minus = np.flatnonzero(c == 2)
+        # a minus has to start a token and be followed by a digit
+        fast = not (~ws[minus] | (c[np.minimum(minus+1, len(c)-1)] != 1) | (minus+1 == len(c))).any()
+    if fast:
+        edges = np.flatnonzero(ws[1:] != ws[:-1])
+        if len(edges) == 0:
+            return np.zeros(0, dtype=np.int64) # only whitespace
+        fast = not ((edges[1::2] - edges[0::2]) > INTEGER_MAX_DIGITS).any()
+    if fast:
+        return np.fromstring(chunk, dtype=np.int64, sep=" ")
 
-def read_integers_from_file(filename: str) -> list[int]:
     integers = []
+    for token in re.split(r'\s+', chunk.decode("utf-8")): # Split on any whitespace
+        if re.fullmatch(r'-?\d+', token) is not None:
+            integers.append(int(token))
     try:
-        with open(filename, 'r', encoding='utf-8') as file:
-            contents = file.read()
-            tokens = re.split(r'\s+', contents) # Split on any whitespace
-            for token in tokens:
-                if re.fullmatch(r'-?\d+', token) is not None:
-                    integers.append(int(token))
+        return np.array(integers, dtype=np.int64)
+    except OverflowError:
+        return np.array(integers, dtype=object)
+
+def iter_integer_chunks(filename:str, chunk_bytes:int=INTEGER_CHUNK_BYTES):
+    """
+    Read a file of whitespace separated integers in bounded memory.
+
+    Yields:
+        Arrays of the integers in each chunk of about chunk_bytes, int64 unless a value
+        doesn't fit (then object). Malformed tokens are skipped like read_integers_from_file does.
+    """
+    try:
+        file = open(filename, 'rb')
     except FileNotFoundError:
         print(f"Error: File '{filename}' not found.")
         raise
+
+    with file:
+        carry = b""
+        while True:
+            data = file.read(chunk_bytes)
+            if not data:
+                break
+            data = carry + data
+            # hold back a token that may continue in the next chunk, splitting at ASCII
+            # whitespace never cuts a multi-byte character in half
+            cut = max(data.rfind(w) for w in b" \t\n\r\f\v") + 1
+            chunk, carry = data[0:cut], data[cut:]
+            if chunk:
+                yield _parse_integer_chunk(chunk)
+        if carry:
+            yield _parse_integer_chunk(carry)
+
+def iter_integers_from_file(filename:str, chunk_bytes:int=INTEGER_CHUNK_BYTES):
+    for chunk in iter_integer_chunks(filename, chunk_bytes):
+        yield from chunk.tolist()
+
+def read_integers_from_file(filename: str) -> list[int]:
+    integers = []
+    with stage("parse") as st:
+        for chunk in iter_integer_chunks(filename):
+            integers.extend(chunk.tolist())
+        st.add_samples(len(integers))
     return integers
 
-# converts a list of values into a list of values corresponding to the new range
+# (min, max) of a file of integers, the first pass of iter_integers_to_new_range
+def integer_file_range(filename:str, chunk_bytes:int=INTEGER_CHUNK_BYTES):
+    lo, hi = None, None
+    for chunk in iter_integer_chunks(filename, chunk_bytes):
+        if len(chunk) > 0:
+            lo = chunk.min() if lo is None else min(lo, chunk.min())
+            hi = chunk.max() if hi is None else max(hi, chunk.max())
+    if lo is None:
+        raise Exception("no integers in '{}'".format(filename))
+    return int(lo), int(hi)
+
+# converts a list (or numpy array) of values into values corresponding to the new range
 def lov_to_new_range(l:list, old_min, old_max, new_min=0, new_max=6, format="i"):
 
     new_min = float(new_min)
@@ -157,6 +1477,20 @@ def lov_to_new_range(l:list, old_min, old_max, new_min=0, new_max=6, format="i")
     # convert to new range
     old_max -= old_min
     r = new_max - new_min
+
+    # numpy arrays are converted as a whole and come back as arrays, with the same values
+    # the list path gives (np.rint rounds halves to even just like round)
+    if isinstance(l, np.ndarray):
+        if old_max == 0 and l.size:
+            raise ZeroDivisionError("division by zero") # as the list path, numpy would give NaN
+        l_zto_f = new_min + ((l - old_min) / old_max) * r
+        if format == "i":
+            return np.rint(l_zto_f).astype(np.int64)
+        elif format == "f":
+            return l_zto_f
+        else:
+            raise Exception("funky format wdym")
+
     l_zto_f = [(new_min + float((i-old_min)/old_max)*float(r)) for i in l]
 
     if format == "i":
@@ -165,3 +1499,336 @@ def lov_to_new_range(l:list, old_min, old_max, new_min=0, new_max=6, format="i")
         return l_zto_f
     else:
         raise Exception("funky format wdym")
+
+# lov_to_new_range for a stream of arrays (e.g. iter_integer_chunks), the bounds must be known up front
+def iter_lov_to_new_range(chunks, old_min, old_max, new_min=0, new_max=6, format="i"):
+    for chunk in chunks:
+        yield lov_to_new_range(np.asarray(chunk), old_min, old_max, new_min, new_max, format)
+
+def iter_integers_to_new_range(filename:str, new_min=0, new_max=6, bounds=None, format="i", chunk_bytes:int=INTEGER_CHUNK_BYTES):
+    """
+    Map every integer of a file to the new range in bounded memory.
+
+    bounds is the (old_min, old_max) to map from, when None the file is read twice and the
+    first pass finds them.
+
+    Yields:
+        Arrays of mapped values, one per chunk of the file
+    """
+    if bounds is None:
+        bounds = integer_file_range(filename, chunk_bytes)
+    yield from iter_lov_to_new_range(iter_integer_chunks(filename, chunk_bytes), bounds[0], bounds[1], new_min, new_max, format)
+
+######################################## EXPORT #########################################
+
+EXPORT_CHUNK = 1 << 16
+EXPORT_LIMIT = 1.0 # limiter ceiling, exported samples never leave [-limit, limit]
+EXPORT_FORMATS = {"wav": "WAV", "flac": "FLAC", "ogg": "OGG"}
+EXPORT_SUBTYPES = {16: "PCM_16", 24: "PCM_24", 32: "FLOAT"} # by bit depth, ogg is always Vorbis
+
+class PeakLimiter:
+    """
+    Lookahead peak limiter for a stream of blocks of shape (frames,) or (frames, channels).
+
+    Works on sub-blocks: each gets the gain that brings its peak down to the ceiling, the gain
+    at the start of a sub-block is the smallest of it and its neighbours, and it ramps linearly
+    to the next one. No sample ever ends up above the ceiling and the gain never jumps. Output
+    lags input by up to two sub-blocks, flush returns the rest.
+    """
+    def __init__(self, ceiling:float=EXPORT_LIMIT, sub_block:int=64):
+        self.ceiling = ceiling
+        self.sub_block = sub_block
+        self.held = None
+        self.prev_gain = 1.0 # gain needed by the sub-block before the held ones
+
+    def limit(self, x, final:bool):
+        S = self.sub_block
+        blocks = -(-len(x) // S) if final else len(x) // S
+        if not final and blocks < 3:
+            return x[0:0], x
+        peaks = np.abs(x[0:blocks*S] if len(x) >= blocks*S else np.concatenate((x, np.zeros((blocks*S - len(x),) + x.shape[1:], dtype=x.dtype))))
+        peaks = peaks.reshape(blocks, -1).max(axis=1)
+        g = np.minimum(1.0, self.ceiling / np.maximum(peaks, 1e-300))
+
+        # a sub-block can be finished once the gains of the two after it are known
+        ready = blocks if final else blocks - 2
+        g_ext = np.concatenate(([self.prev_gain], g, [1.0, 1.0]))
+        G = np.minimum(np.minimum(g_ext[0:-2], g_ext[1:-1]), g_ext[2:])[0:ready+1]
+        self.prev_gain = g[ready-1] if ready > 0 else self.prev_gain
+
+        out_len = min(len(x), ready*S)
+        y = x[0:out_len]
+        if (G < 1.0).any():
+            ramp = np.repeat(G[0:-1], S) + np.repeat(np.diff(G), S) * np.tile(np.arange(S) / S, ready)
+            ramp = ramp[0:out_len]
+            y = y * (ramp if y.ndim == 1 else ramp[:, None])
+        return y, x[out_len:]
+
+    def process(self, block):
+        x = block if self.held is None else np.concatenate((self.held, block))
+        y, self.held = self.limit(x, final=False)
+        return y
+
+    def flush(self):
+        if self.held is None or len(self.held) == 0:
+            return self.held if self.held is not None else np.zeros(0)
+        y, self.held = self.limit(self.held, final=True)
+        return y
+
+class PolyphaseResampler:
+    """
+    Streaming rational resampler (sr_out/sr_in reduced to up/down) with a Kaiser windowed sinc
+    low-pass, evaluated only at the output times. The filter phases repeat every up outputs,
+    for which the input advances by exactly down samples, so each such period is one row of a
+    matrix product between a strided view of the input and a precomputed (up x window) matrix.
+    Works on blocks of shape (frames,) or (frames, channels); flush returns the end of the
+    stream, which is ceil(input length * up / down) samples long in total.
+    """
+    def __init__(self, sr_in:int, sr_out:int, attenuation_db:float=100.0, rolloff:float=0.9):
+        g = math.gcd(int(sr_in), int(sr_out))
+        self.up = L = int(sr_out) // g
+        self.down = M = int(sr_in) // g
+
+        # filter designed at the upsampled rate, cutoff below the lower of the two Nyquists
+        cutoff = rolloff * 0.5 * min(1.0, L / M) / L # cycles per upsampled sample
+        transition = (1 - rolloff) * 0.5 * min(1.0, L / M) / L
+        N = int(math.ceil((attenuation_db - 8) / (2.285 * 2*np.pi*transition))) | 1
+        beta = 0.1102 * (attenuation_db - 8.7)
+        m = np.arange(N) - (N - 1) / 2
+        h = 2*cutoff * np.sinc(2*cutoff*m) * np.kaiser(N, beta) * L
+        T = -(-N // L)
+        H = np.zeros(T*L)
+        H[0:N] = h
+        delay = (N - 1) // 2
+
+        # output r of a period reads inputs newest[r] - j (j < T) with filter phase[r], newest
+        # relative to the start of the period's input, which is down samples further each period
+        r = np.arange(L)
+        newest = (r*M + delay) // L
+        phase = (r*M + delay) % L
+        self.first = int(newest[0]) - T + 1 # first input a period reads
+        self.window = int(newest[-1]) - self.first + 1
+        self.matrix = np.zeros((L, self.window))
+        for j in range(T):
+            self.matrix[r, newest - j - self.first] = H[phase + j*L]
+
+        self.x = None
+        self.x_start = 0 # global index of self.x[0]
+        self.n_in = 0
+        self.periods = 0 # periods of up outputs done
+
+    def resample(self, periods:int):
+        # whole periods self.periods .. periods-1, with zeros before the start of the stream
+        count = periods - self.periods
+        if count <= 0:
+            return self.x[0:0]
+        lo = self.periods*self.down + self.first
+        if lo < self.x_start:
+            self.x = np.concatenate((np.zeros((self.x_start - lo,) + self.x.shape[1:], dtype=self.x.dtype), self.x))
+            self.x_start = lo
+        x = self.x[lo - self.x_start:]
+        view = np.lib.stride_tricks.as_strided(x, (count, self.window) + x.shape[1:], (x.strides[0]*self.down,) + x.strides, writeable=False)
+        if x.ndim == 1:
+            y = (view @ self.matrix.T).reshape(-1)
+        else:
+            y = np.einsum("qwc,rw->qrc", view, self.matrix).reshape(-1, x.shape[1])
+        self.periods = periods
+
+        # drop inputs no later period reads
+        drop = self.periods*self.down + self.first - self.x_start
+        if drop > 0:
+            self.x = self.x[drop:]
+            self.x_start += drop
+        return y.astype(self.x.dtype, copy=False)
+
+    def process(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        self.x = block.copy() if self.x is None else np.concatenate((self.x, block))
+        self.n_in += len(block)
+        # periods whose last input has arrived
+        ready = (self.n_in - self.first - self.window) // self.down + 1
+        return self.resample(max(self.periods, ready))
+
+    def flush(self):
+        if self.x is None:
+            return np.zeros(0)
+        total = -(-self.n_in * self.up // self.down)
+        periods = -(-total // self.up)
+        done = self.periods * self.up
+        end = (periods - 1)*self.down + self.first + self.window # one past the last input read
+        self.x = np.concatenate((self.x, np.zeros((max(0, end - self.x_start - len(self.x)),) + self.x.shape[1:], dtype=self.x.dtype)))
+        return self.resample(periods)[0:total - done]
+
+def dither_to_int(block, bits:int, rng):
+    """
+    Quantize [-1, 1) samples to bits with TPDF dither (the difference of two uniform values,
+    +-1 LSB). Returns int16 for 16 bits, or int32 holding the 24-bit value in its top bytes.
+    """
+    scale = 2**(bits - 1)
+    x = block * scale
+    if rng is not None:
+        x = x + (rng.random(x.shape) - rng.random(x.shape))
+    q = np.clip(np.floor(x + 0.5), -scale, scale - 1)
+    return q.astype(np.int16) if bits == 16 else q.astype(np.int32) << (32 - bits)
+
+def export_file_name(file_name:str, format=None) -> str:
+    # file_name with the extension of format, e.g. hrm.wav -> hrm.flac
+    return file_name if format is None else os.path.splitext(file_name)[0] + "." + format
+
+class ExportWriter:
+    """
+    One output file fed block by block, in one pass: gain, resampling to sr_out, peak limiting
+    to limit, dithered conversion to bits and encoding (wav, flac or ogg, from format or the
+    file extension). limit=None turns the limiter off, bits=32 writes float samples. The
+    directory is created if needed, errors are raised rather than written somewhere else.
+    """
+    def __init__(self, file_name:str, sr:int=44100, channels:int=1, sr_out=None, bits:int=16, format=None, gain:float=1.0,
+                 limit=EXPORT_LIMIT, dither:bool=True, seed:int=0):
+        self.file_name = export_file_name(file_name, format)
+        format = os.path.splitext(self.file_name)[1][1:].lower()
+        if format not in EXPORT_FORMATS:
+            raise Exception("unknown export format '{}'".format(format))
+        if bits not in EXPORT_SUBTYPES:
+            raise Exception("bits must be one of {}".format(sorted(EXPORT_SUBTYPES)))
+        subtype = "VORBIS" if format == "ogg" else EXPORT_SUBTYPES[bits]
+        if format == "flac" and bits == 32:
+            raise Exception("flac is 16 or 24 bit")
+
+        self.gain = gain
+        self.resampler = PolyphaseResampler(sr, sr_out) if sr_out and sr_out != sr else None
+        self.limiter = PeakLimiter(limit) if limit else None
+        self.bits = bits if subtype.startswith("PCM") else None
+        self.rng = np.random.default_rng(seed) if dither and self.bits else None
+        self.samples = 0
+
+        directory = os.path.dirname(self.file_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = sf.SoundFile(self.file_name, "w", samplerate=sr_out or sr, channels=channels, format=EXPORT_FORMATS[format], subtype=subtype)
+
+    def encode(self, block):
+        if self.limiter is not None:
+            block = self.limiter.process(block)
+        if len(block) > 0:
+            self.file.write(dither_to_int(block, self.bits, self.rng) if self.bits else block)
+
+    def write(self, block):
+        self.samples += len(block)
+        block = np.asarray(block, dtype=np.float64)
+        if self.gain != 1.0:
+            block = block * self.gain
+        self.encode(self.resampler.process(block) if self.resampler is not None else block)
+
+    def close(self):
+        if self.resampler is not None:
+            self.encode(self.resampler.flush())
+        if self.limiter is not None:
+            block = self.limiter.flush()
+            if len(block) > 0:
+                self.file.write(dither_to_int(block, self.bits, self.rng) if self.bits else block)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def export_signals(signals:dict, files:dict, sr:int=44100, normalize=None, workers=None, chunk:int=EXPORT_CHUNK, **options) -> dict:
+    """
+    Write every voice's signal to its file, each voice in its own thread (NumPy and libsndfile
+    release the GIL for the heavy parts).
+
+    Args:
+        signals: Dictionary mapping voice name to its rendered signal
+        files: Dictionary mapping voice name to output file name
+        normalize: Scale each signal so its peak is this, before anything else (None keeps the level)
+        options: ExportWriter options (sr_out, bits, format, limit, dither)
+
+    Returns:
+        Dictionary mapping voice name to the file actually written (the extension follows format)
+    """
+    def export_one(v, seed):
+        signal = signals[v]
+        gain = 1.0
+        if normalize:
+            peak = float(np.max(np.abs(signal))) if len(signal) else 0.0
+            gain = normalize / peak if peak > 0 else 1.0
+        with stage("wav write", len(signal)):
+            with ExportWriter(files[v], sr, 1 if np.ndim(signal) == 1 else signal.shape[1], gain=gain, seed=seed, **options) as w:
+                for i in range(0, len(signal), chunk):
+                    w.write(signal[i:i+chunk])
+        return w.file_name
+
+    if len(files) == 1 or workers == 1:
+        return {v: export_one(v, seed) for seed, v in enumerate(files)}
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers or len(files)) as pool:
+        futures = {v: pool.submit(export_one, v, seed) for seed, v in enumerate(files)}
+        return {v: f.result() for v, f in futures.items()}
+
+def add_export_args(parser, normalize:bool=True):
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), help="output encoding (default from the file names, wav)")
+    parser.add_argument("--bits", type=int, choices=sorted(EXPORT_SUBTYPES), default=16, help="PCM bit depth, 32 = float (wav only)")
+    parser.add_argument("--rate", type=int, help="resample the output to this sample rate, e.g. 22050 or 48000")
+    parser.add_argument("--limit", type=float, default=EXPORT_LIMIT, help="peak limiter ceiling, 0 turns it off")
+    parser.add_argument("--no-dither", action="store_true", help="round instead of adding TPDF dither before quantizing")
+    if normalize:
+        parser.add_argument("--normalize", type=float, help="scale every output to this peak, e.g. 0.98")
+
+# keyword arguments for export_signals / write_blocks from the add_export_args flags
+def export_options_from_args(args) -> dict:
+    options = {"format": args.format, "bits": args.bits, "sr_out": args.rate, "limit": args.limit or None, "dither": not args.no_dither}
+    if getattr(args, "normalize", None):
+        options["normalize"] = args.normalize
+    return options
+
+######################################## PLOTTING #########################################
+
+PLOT_MAX_POINTS = 4000
+
+def minmax_decimate(signal, max_points:int=PLOT_MAX_POINTS, sr:int=44100):
+    """
+    Shrink a signal for plotting to the minimum and maximum of each of max_points/2 equal
+    buckets, in time order, so the outline and every peak survive while millions of samples
+    become a few thousand points. Signals that are already short enough are left alone.
+
+    Returns:
+        (times in seconds, values)
+    """
+    signal = np.asarray(signal)
+    n = len(signal)
+    if n <= max_points:
+        return np.arange(n) / sr, signal
+    starts = np.linspace(0, n, max_points // 2, endpoint=False).astype(np.intp)
+    lo = np.minimum.reduceat(signal, starts)
+    hi = np.maximum.reduceat(signal, starts)
+    return np.repeat(starts, 2) / sr, np.column_stack((lo, hi)).ravel()
+
+def plot_signals(signals, file_name:str, title:str="Signal Plots", labels=("Harm", "Sine", "Tri"), size=(8, 4), sr:int=44100, max_points:int=PLOT_MAX_POINTS):
+    """
+    Plot each signal in its own row, min/max decimated to max_points, and save the figure
+    to file_name (or to its bare name in the current directory if that fails).
+    """
+    import matplotlib.pyplot as plt
+
+    fig, axs = plt.subplots(len(signals), 1, layout='constrained', squeeze=False)
+    axs = axs[:, 0]
+
+    fig.align_labels()
+    fig.set_size_inches(*size)
+    fig.set_dpi(100)
+    fig.suptitle(title, fontsize=20)
+
+    for ax, signal, label in zip(axs, signals, labels):
+        ax.plot(*minmax_decimate(signal, max_points, sr))
+        ax.set_title(label)
+        ax.set_ylabel("Amplitude")
+
+    axs[-1].set_xlabel("Time (seconds)")
+
+    try:
+        fig.savefig(file_name)
+    except:
+        fig.savefig(os.path.basename(file_name))
+    plt.close(fig)
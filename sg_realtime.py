@@ -0,0 +1,278 @@
+import numpy as np
+import soundfile as sf
+from sg_functions import *
+import argparse, sys, time
+
+# realtime playback of note streams. A RealtimeEngine renders the next block whenever its sink
+# asks for one, only the slice of every note that falls inside it, in the audio callback for
+# a sound card (SoundDeviceSink, needs the optional sounddevice package) or in a loop for
+# NullSink and FileSink, which run anywhere, including headless CI. Every block is timed
+# against its deadline, the length of the block in seconds.
+#
+#   python sg_realtime.py --sink null --block-size 256 --fail-on-underrun
+
+REALTIME_BLOCK_SIZE = 512
+REALTIME_LATENCY_BLOCKS = 2 # blocks queued ahead of the output by the loop driven sinks
+REALTIME_CHUNK_BYTES = 1 << 16 # input read per chunk while playing, small enough to parse within a block
+
+class RealtimeEngine:
+    """
+    Hands out a stream of rendered blocks in whatever sizes the sink asks for.
+
+    blocks is any iterable of 1-D sample arrays (e.g. voice_blocks), it is only advanced when
+    the output needs more samples, so synthesis happens inside the callback and per block work
+    is bounded by the block size plus the longest single note.
+
+    stats counts blocks and samples delivered, underruns (the output ran dry), late blocks
+    (rendering took longer than the block lasts) and the time spent rendering.
+    """
+    def __init__(self, blocks, sr:int=44100):
+        self.blocks = iter(blocks)
+        self.sr = sr
+        self.current = np.zeros(0)
+        self.pos = 0
+        self.finished = False
+        self.stats = {"blocks": 0, "samples": 0, "underruns": 0, "late_blocks": 0, "render_seconds": 0.0, "max_render_seconds": 0.0}
+
+    def render(self, out) -> int:
+        """
+        Fill out (frames, or frames x channels, every channel gets the same samples) with the
+        next samples of the stream. Returns how many frames were filled, fewer than asked
+        (rest zeroed) once the stream has ended.
+        """
+        start = time.perf_counter()
+        frames = len(out)
+        filled = 0
+        with stage("realtime block", frames):
+            while filled < frames and not self.finished:
+                if self.pos >= len(self.current):
+                    self.current = next(self.blocks, None)
+                    self.pos = 0
+                    if self.current is None:
+                        self.finished = True
+                        break
+                    continue
+                n = min(frames - filled, len(self.current) - self.pos)
+                chunk = self.current[self.pos:self.pos+n]
+                if out.ndim == 2:
+                    out[filled:filled+n] = chunk[:, None]
+                else:
+                    out[filled:filled+n] = chunk
+                filled += n
+                self.pos += n
+            out[filled:] = 0
+
+        elapsed = time.perf_counter() - start
+        self.stats["blocks"] += 1
+        self.stats["samples"] += filled
+        self.stats["render_seconds"] += elapsed
+        self.stats["max_render_seconds"] = max(self.stats["max_render_seconds"], elapsed)
+        if elapsed > frames / self.sr:
+            self.stats["late_blocks"] += 1
+        return filled
+
+    def summary(self) -> dict:
+        s = dict(self.stats)
+        audio_seconds = s["samples"] / self.sr
+        s["mean_render_seconds"] = s["render_seconds"] / s["blocks"] if s["blocks"] else 0.0
+        s["realtime_factor"] = audio_seconds / s["render_seconds"] if s["render_seconds"] > 0 else float("inf")
+        return s
+
+def voice_takes_start(generator) -> bool:
+    # whether a voice generator can render a note from a sample index on (see register_voice)
+    import inspect
+    try:
+        return "start" in inspect.signature(generator).parameters
+    except (TypeError, ValueError):
+        return False
+
+def voice_blocks(notes, voice:str="sin", block_size:int=REALTIME_BLOCK_SIZE, dtype=np.float32, k=8, amp=1.0, sr=44100,
+                 A=0.04, D=0.06, S=0.6, R=0.05):
+    """
+    One voice of a note stream as blocks of block_size samples (the last one shorter), the
+    block source a RealtimeEngine plays. The samples are the same as render_blocks, but only
+    the part of each note that falls inside the block is synthesized, oscillator and envelope
+    alike, so the work per block is bounded by the block size however long the notes are.
+    Voices whose generator takes no start are rendered whole when a note begins.
+    """
+    if voice not in VOICES:
+        raise Exception("unknown voice '{}'".format(voice))
+    generator = VOICES[voice]
+    sliced = voice_takes_start(generator)
+
+    notes = iter(notes)
+    freq, duration, length, pos, whole = 0, 0.0, 0, 0, None
+    while True:
+        block = np.zeros(block_size, dtype=dtype)
+        fill = 0
+        while fill < block_size:
+            if pos >= length:
+                note = next(notes, None)
+                if note is None:
+                    break
+                freq, duration = note[0], note[1]
+                length, pos, whole = ADSR_length(duration, R, sr), 0, None
+                if freq != 0 and not sliced:
+                    with stage("oscillators", length):
+                        whole = generator(freq, amp, length, k=k, sr=sr, dtype=dtype) * ADSR_envelope(duration, A, D, S, R, sr=sr, dtype=dtype)
+                continue
+
+            # rests are left as the zeros the block starts with
+            n = min(block_size - fill, length - pos)
+            if whole is not None:
+                block[fill:fill+n] = whole[pos:pos+n]
+            elif freq != 0:
+                with stage("oscillators", n):
+                    signal = generator(freq, amp, n, k=k, sr=sr, dtype=dtype, start=pos)
+                with stage("envelope", n):
+                    envelope = ADSR_envelope_slice(duration, pos, n, A, D, S, R, sr=sr, dtype=dtype)
+                np.multiply(signal, envelope, out=block[fill:fill+n])
+            fill += n
+            pos += n
+
+        if fill > 0:
+            yield block if fill == block_size else block[0:fill]
+        if fill < block_size:
+            return
+
+def _drive(engine:RealtimeEngine, block_size:int, write, realtime:bool, latency_blocks:int):
+    # render blocks in a loop like a sound card would ask for them. With realtime the loop is
+    # paced to the clock and a block finished after the output would have played it counts as
+    # an underrun, otherwise blocks are rendered back to back and only late blocks are counted
+    period = block_size / engine.sr
+    out = np.zeros(block_size, dtype=np.float32)
+    start = time.perf_counter()
+    i = 0
+    while not engine.finished:
+        filled = engine.render(out)
+        if filled > 0:
+            write(out[0:filled])
+        if realtime:
+            # block i is due latency_blocks periods after the output asks for it
+            now = time.perf_counter()
+            if now > start + (i + latency_blocks) * period:
+                engine.stats["underruns"] += 1
+            time.sleep(max(0.0, start + (i + 1) * period - now)) # until the output asks for the next block
+        i += 1
+
+class NullSink:
+    """
+    Discards the audio, for measuring render time per block without a sound card.
+    """
+    def __init__(self, block_size:int=REALTIME_BLOCK_SIZE, realtime:bool=False, latency_blocks:int=REALTIME_LATENCY_BLOCKS):
+        self.block_size = block_size
+        self.realtime = realtime
+        self.latency_blocks = latency_blocks
+
+    def play(self, engine:RealtimeEngine) -> dict:
+        _drive(engine, self.block_size, lambda block: None, self.realtime, self.latency_blocks)
+        return engine.summary()
+
+class FileSink(NullSink):
+    """
+    Writes the audio to a WAV file block by block, exactly what a sound card would have played.
+    """
+    def __init__(self, file_name:str, block_size:int=REALTIME_BLOCK_SIZE, realtime:bool=False, latency_blocks:int=REALTIME_LATENCY_BLOCKS):
+        super().__init__(block_size, realtime, latency_blocks)
+        self.file_name = file_name
+
+    def play(self, engine:RealtimeEngine) -> dict:
+        with sf.SoundFile(self.file_name, "w", samplerate=engine.sr, channels=1) as f:
+            _drive(engine, self.block_size, f.write, self.realtime, self.latency_blocks)
+        return engine.summary()
+
+class SoundDeviceSink:
+    """
+    Plays through the default (or given) output device with the sounddevice package, rendering
+    in its callback. Underruns are the output underflows reported by the device.
+    """
+    def __init__(self, block_size:int=REALTIME_BLOCK_SIZE, device=None, latency="low"):
+        self.block_size = block_size
+        self.device = device
+        self.latency = latency
+
+    def play(self, engine:RealtimeEngine) -> dict:
+        import sounddevice as sd
+        import threading
+
+        done = threading.Event()
+
+        def callback(outdata, frames, time_info, status):
+            if status.output_underflow:
+                engine.stats["underruns"] += 1
+            if engine.render(outdata) < frames:
+                raise sd.CallbackStop
+
+        with sd.OutputStream(samplerate=engine.sr, blocksize=self.block_size, channels=1, dtype="float32",
+                             device=self.device, latency=self.latency, callback=callback, finished_callback=done.set):
+            done.wait()
+        return engine.summary()
+
+def sounddevice_available() -> bool:
+    try:
+        import sounddevice as sd
+        sd.query_devices(kind="output")
+        return True
+    except Exception: # not installed, no PortAudio, or no output device
+        return False
+
+def default_sink(block_size:int=REALTIME_BLOCK_SIZE):
+    return SoundDeviceSink(block_size) if sounddevice_available() else NullSink(block_size)
+
+def play(notes, voice:str="sin", sink=None, block_size:int=REALTIME_BLOCK_SIZE, sr:int=44100, **kwargs) -> dict:
+    """
+    Play a note stream as it is rendered, on the sound card when there is one.
+    kwargs are passed on to voice_blocks (dtype, k, amp, A, D, S, R). Returns the engine summary.
+    """
+    if sink is None:
+        sink = default_sink(block_size)
+    engine = RealtimeEngine(voice_blocks(notes, voice, block_size, sr=sr, **kwargs), sr)
+    return sink.play(engine)
+
+def beep(freq:float, duration_ms:int):
+    """
+    A short sine tone on the sound card, skipped (without waiting) when there is none.
+    """
+    if sounddevice_available():
+        play([[freq, duration_ms/1000]], "sin", amp=0.3, A=0.005, D=0.0, S=1.0, R=0.005)
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description="play a file of integers in realtime and report whether rendering keeps up")
+    parser.add_argument("--input", default="data_txt/input.txt", help="file of integers, turned into notes like mus_from_nums does")
+    parser.add_argument("--range", nargs=2, type=int, metavar=("MIN", "MAX"), help="smallest and largest integer of the input, skips the pass over the file that finds them")
+    parser.add_argument("--voice", choices=sorted(VOICES), default="hrm")
+    parser.add_argument("--block-size", type=int, default=REALTIME_BLOCK_SIZE, help="samples per callback")
+    parser.add_argument("--sink", choices=["device", "null", "file"], default="null", help="sound card, nothing, or --output")
+    parser.add_argument("--output", default="realtime.wav", help="WAV file of the file sink")
+    parser.add_argument("--realtime", action="store_true", help="pace the null and file sinks to the clock")
+    parser.add_argument("--fail-on-underrun", action="store_true", help="exit with status 1 if any block was late or underran")
+    add_profiling_args(parser)
+    args = parser.parse_args()
+    enable_profiling_from_args(args)
+
+    # the notes are read from the file while playing, only the range is found up front
+    from mus_from_nums import iter_numbers_to_notes
+    bounds = args.range or integer_file_range(args.input)
+    notes = iter_numbers_to_notes(args.input, bounds=bounds, chunk_bytes=REALTIME_CHUNK_BYTES)
+
+    if args.sink == "device":
+        sink = SoundDeviceSink(args.block_size)
+    elif args.sink == "file":
+        sink = FileSink(args.output, args.block_size, args.realtime)
+    else:
+        sink = NullSink(args.block_size, args.realtime)
+
+    s = play(notes, args.voice, sink, args.block_size, amp=0.7)
+
+    print("{} blocks of {} samples ({:0.2f} ms), {:0.2f} sec of audio".format(s["blocks"], args.block_size, 1000*args.block_size/SAMPLE_RATE, s["samples"]/SAMPLE_RATE))
+    print("render per block: mean {:0.3f} ms, max {:0.3f} ms, {:0.1f}x realtime".format(1000*s["mean_render_seconds"], 1000*s["max_render_seconds"], s["realtime_factor"]))
+    print("late blocks: {}, underruns: {}".format(s["late_blocks"], s["underruns"]))
+
+    print_profile_summary()
+
+    if args.fail_on_underrun and (s["late_blocks"] or s["underruns"]):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import numpy as np
+import soundfile as sf
+import pytest, re
+from sg_functions import *
+
+# pitches the scripts play: mus_from_nums (A major two octaves down), the three octaves of
+# image_to_sound, quote_to_morse and sound_generator
+A_MAJ = [440.00, 493.88, 523.25, 587.33, 659.25, 739.99, 783.99]
+PITCHES = sorted(set([f/4 for f in A_MAJ] + [f/2 for f in A_MAJ] + A_MAJ + [277.18*2, 110]))
+
+SR = 44100
+DURATION = 0.05
+NUM_SINUSOIDS = 1000 # generate_triangle's default, what the scripts render with
+
+# band limiting drops the odd harmonics at or above Nyquist, so the band-limited triangle can
+# differ from the full additive one by at most the sum of their weights
+def dropped_weight(freq:float) -> float:
+    kept = min(NUM_SINUSOIDS, odd_harmonics_below_nyquist(freq, SR))
+    return 8/np.pi**2 * sum(1/(2*i+1)**2 for i in range(kept, NUM_SINUSOIDS))
+
+# at every pitch above that bound stays under 2% of the amplitude
+TRIANGLE_MAX_ERROR = 0.02
+
+@pytest.mark.parametrize("freq", PITCHES)
+def test_band_limited_triangle_matches_additive(freq):
+    note_num = freq2midi(freq)
+    band_limited = generate_triangle(note_num, 1.0, DURATION, NUM_SINUSOIDS, SR)
+    additive = generate_triangle(note_num, 1.0, DURATION, NUM_SINUSOIDS, SR, band_limited=False)
+
+    error = np.abs(band_limited - additive).max()
+    assert len(band_limited) == len(additive)
+    assert error <= dropped_weight(midi2freq(note_num)) + 1e-12
+    assert error < TRIANGLE_MAX_ERROR
+
+# the wavetable voice against the band-limited additive triangle (linear interpolation error)
+TRI_VOICE_MAX_ERROR = 1e-4
+
+@pytest.mark.parametrize("freq", PITCHES)
+def test_tri_voice_matches_additive(freq):
+    note_num = freq2midi(freq)
+    additive = generate_triangle(note_num, 1.0, DURATION, NUM_SINUSOIDS, SR, band_limited=False)
+    band_limited = generate_triangle(note_num, 1.0, DURATION, NUM_SINUSOIDS, SR)
+    voice = tri_voice(freq, 1.0, len(additive), sr=SR)
+
+    assert np.abs(voice - band_limited).max() < TRI_VOICE_MAX_ERROR
+    assert np.abs(voice - additive).max() < TRIANGLE_MAX_ERROR + TRI_VOICE_MAX_ERROR
+
+def test_lov_to_new_range_array_matches_list():
+    values = list(range(-5, 40, 3)) + [7, 7, 12]
+    for format in ("i", "f"):
+        expected = lov_to_new_range(values, min(values), max(values), 0, 6, format)
+        assert list(lov_to_new_range(np.array(values), min(values), max(values), 0, 6, format)) == expected
+
+def test_lov_to_new_range_flat_range_raises():
+    with pytest.raises(ZeroDivisionError):
+        lov_to_new_range([3, 3], 3, 3)
+    with pytest.raises(ZeroDivisionError):
+        lov_to_new_range(np.array([3, 3]), 3, 3)
+
+# a short stream with repeated and new notes, rests and a note shorter than the attack
+CACHE_NOTES = [[220, 0.05], [0, 0.02], [330, 0.01], [220, 0.05], [440, 0.03]]
+
+def test_render_cache_round_trip(tmp_path):
+    cache = RenderCache(str(tmp_path))
+    reference = render_voices(CACHE_NOTES)
+    for _ in range(2): # a miss that stores every note and stream, then a stream hit
+        cached = render_voices(CACHE_NOTES, cache=cache)
+        for v in reference:
+            assert np.array_equal(cached[v], reference[v])
+    assert cache.stats["stream_misses"] == 3 and cache.stats["stream_hits"] == 3
+
+    edited = CACHE_NOTES + [[330, 0.01]] # a new stream made only of notes on disk
+    reopened = RenderCache(str(tmp_path))
+    cached = render_voices(edited, cache=reopened)
+    for v, signal in render_voices(edited).items():
+        assert np.array_equal(cached[v], signal)
+    assert reopened.stats["stream_misses"] == 3 and reopened.stats["note_misses"] == 0
+
+def test_render_cache_eviction(tmp_path):
+    note_bytes = ADSR_length(0.05, 0.05, 44100) * 8
+    cache = RenderCache(str(tmp_path), max_bytes=5*note_bytes)
+    for i in range(8):
+        render_voices([[110 * (i+1), 0.05]], voices=("sin",), cache=cache)
+        assert sum(size for path, size, mtime in cache.entries()) <= cache.max_bytes
+    assert cache.stats["evicted"] > 0
+
+    # too big to ever fit, so it isn't written at all
+    evicted = cache.stats["evicted"]
+    signal = render_voices([[220, 0.5]], voices=("sin",), cache=cache)["sin"]
+    assert np.array_equal(signal, render_voices([[220, 0.5]], voices=("sin",))["sin"])
+    assert all(size < signal.nbytes for path, size, mtime in cache.entries())
+    assert cache.stats["evicted"] == evicted
+
+FLOAT32_NOTES = [[f, d] for f, d in zip(PITCHES, [0.075, 0.3, 0.01, 0.05, 0.15] * len(PITCHES))] + [[0, 0.05]]
+
+@pytest.mark.parametrize("voice", sorted(VOICES))
+@pytest.mark.parametrize("amp", [0.3, 1.0])
+def test_float32_render_matches_float64(voice, amp):
+    for envelope in ({}, {"A": 0.01, "D": 0.0, "S": 1.0, "R": 0.01}):
+        single = render_voices(FLOAT32_NOTES, (voice,), amp=amp, dtype=np.float32, **envelope)[voice]
+        double = render_voices(FLOAT32_NOTES, (voice,), amp=amp, **envelope)[voice]
+        assert single.dtype == np.float32 and len(single) == len(double)
+        assert np.abs(single - double).max() <= FLOAT32_MAX_ERROR * amp
+
+INCREMENTAL_PITCHES = [0, 110, 220, 277.18, 330, 440]
+INCREMENTAL_DURATIONS = [0.01, 0.03, 0.075]
+
+def random_note(rng):
+    return [float(rng.choice(INCREMENTAL_PITCHES)), float(rng.choice(INCREMENTAL_DURATIONS))]
+
+# applies a random insert, delete or replace (of one note or a short run) in place
+def random_edit(rng, notes):
+    i = int(rng.integers(0, len(notes) + 1))
+    run = int(rng.integers(1, 4))
+    op = rng.choice(["insert", "delete", "replace"]) if len(notes) > 4 else "insert"
+    if op == "insert":
+        notes[i:i] = [random_note(rng) for _ in range(run)]
+    elif op == "delete":
+        del notes[i:i+run]
+    else:
+        notes[i:i+run] = [random_note(rng) for _ in notes[i:i+run]]
+
+def test_incremental_renderer_in_memory():
+    rng = np.random.default_rng(1)
+    notes = [random_note(rng) for _ in range(40)]
+    renderer = IncrementalRenderer(amp=0.5)
+    modes = set()
+    for _ in range(40):
+        modes.add(renderer.render(notes)["mode"])
+        reference = render_voices(notes, amp=0.5)
+        for v, signal in renderer.signals().items():
+            assert np.array_equal(signal, reference[v])
+        random_edit(rng, notes)
+    assert {"full", "patch", "shift"} <= modes
+
+def test_incremental_renderer_reopened_from_index(tmp_path):
+    # float WAV without limiter or dither, so the files hold the render rounded to float32
+    files = {v: str(tmp_path / (v + ".wav")) for v in ("hrm", "sin", "tri")}
+    index_file = str(tmp_path / "render_index.npz")
+    options = dict(amp=0.5, bits=32, limit=None, dither=False)
+    rng = np.random.default_rng(2)
+    notes = [random_note(rng) for _ in range(40)]
+    modes = []
+    for _ in range(25):
+        renderer = IncrementalRenderer(files, index_file, **options)
+        modes.append(renderer.render(notes)["mode"])
+        reference = render_voices(notes, amp=0.5)
+        for v, signal in renderer.signals().items():
+            assert np.array_equal(signal, reference[v].astype(np.float32))
+        random_edit(rng, notes)
+    assert modes[0] == "full" and "full" not in modes[1:]
+    assert {"patch", "shift"} <= set(modes)
+
+    # different synthesis parameters don't match the index, so everything is rendered again
+    assert IncrementalRenderer(files, index_file, **dict(options, amp=0.25)).render(notes)["mode"] == "full"
+
+def test_event_blocks_fan_out_to_every_voice():
+    # overlapping notes, a chord, a rest and a note shorter than one sample
+    events = [(0.0, 0.05, 220, 1.0, "hrm"), (0.02, 0.1, 330, 0.5, "sin"), (0.02, 0.03, 440, 0.8, "tri"),
+              (0.2, 0.01, 0, 1.0, "hrm"), (0.3, 0.0, 110, 1.0, "sin")]
+    voices = ("hrm", "sin", "tri")
+    fanned = list(render_event_blocks(events, 1000, voices=voices))
+    for v in voices:
+        single = [(onset, duration, freq, velocity, v) for onset, duration, freq, velocity, voice in events]
+        expected = np.concatenate(list(render_event_blocks(single, 1000)))
+        assert np.array_equal(np.concatenate([block[v] for block in fanned]), expected)
+        assert np.array_equal(expected, render_events(single))
+
+@pytest.mark.parametrize("pan", [None, {"hrm": -0.5, "tri": 0.8}])
+def test_channel_blocks_match_render_channels(tmp_path, pan):
+    notes = FLOAT32_NOTES
+    options = dict(voices=("hrm", "sin", "tri"), pan=pan, gain={"sin": 0.5})
+    frames = render_channels(notes, amp=0.3, **options)
+    blocks = list(channel_blocks(render_blocks(notes, options["voices"], 1000, amp=0.3), **options))
+    assert np.array_equal(np.concatenate(blocks), frames)
+
+    # written block by block as one float file, without limiter, the render rounded to float32
+    file_name = str(tmp_path / "voices.wav")
+    written = write_blocks(({"voices": block} for block in blocks), {"voices": file_name}, channels=channel_count(**options), bits=32, limit=None)
+    assert written == len(frames)
+    assert np.array_equal(sf.read(file_name, dtype="float32")[0], frames.astype(np.float32))
+
+def test_morse_blocks_match_render_morse():
+    from quote_to_morse import render_morse, render_morse_blocks
+    args = dict(dit_len_ms=100, frequency=554.36, amp=0.7, A=0.01, D=0.0, S=1.0, R=0.01)
+    signals = render_morse("sos, the opposite of poverty", **args)
+    for block_size in (441, 1000, 8192, 10**7):
+        blocks = list(render_morse_blocks("sos, the opposite of poverty", block_size=block_size, **args))
+        for v, signal in signals.items():
+            assert np.array_equal(np.concatenate([b[v] for b in blocks]), signal)
+
+# read_integers_from_file as it was before the chunked reader
+def regex_read_integers(filename):
+    with open(filename, "r", encoding="utf-8") as file:
+        return [int(token) for token in re.split(r"\s+", file.read()) if re.fullmatch(r"-?\d+", token) is not None]
+
+INTEGER_TOKENS = ["0", "7", "-12", "007", "-0", "123456789012345678", "99999999999999999999", "-99999999999999999999",
+                  "1.5", "12a", "a12", "+4", "-", "--3", "3-", "1e5", "0x1f", "\u0663\u0664", "-\u0667", "x"]
+SEPARATORS = [" ", "  ", "\n", "\r\n", "\t", "\f\v", "\u00a0", "\u2003", "\x1c"]
+
+def random_integer_text(rng, tokens:int) -> str:
+    text = rng.choice(["", " ", "\n"])
+    for _ in range(tokens):
+        text += str(rng.choice(INTEGER_TOKENS)) if rng.random() < 0.4 else str(int(rng.integers(-10**6, 10**6)))
+        text += str(rng.choice(SEPARATORS))
+    return text + rng.choice(["", "\n", "42"])
+
+@pytest.mark.parametrize("seed", range(5))
+def test_chunked_integer_reader_matches_regex_reader(tmp_path, seed):
+    rng = np.random.default_rng(seed)
+    path = tmp_path / "input.txt"
+    path.write_text(random_integer_text(rng, 300), encoding="utf-8")
+    expected = regex_read_integers(path)
+    assert read_integers_from_file(str(path)) == expected
+    for chunk_bytes in (1, 2, 3, 7, 64, 1000, INTEGER_CHUNK_BYTES):
+        assert list(iter_integers_from_file(str(path), chunk_bytes)) == expected
+
+def test_chunked_integer_reader_well_formed(tmp_path):
+    # plain ASCII integers take the NumPy path, chunks split them anywhere
+    values = np.random.default_rng(0).integers(-10**9, 10**9, 5000)
+    path = tmp_path / "input.txt"
+    path.write_text(" ".join(map(str, values)) + "\n", encoding="utf-8")
+    for chunk_bytes in (5, 17, 4096, INTEGER_CHUNK_BYTES):
+        assert list(iter_integers_from_file(str(path), chunk_bytes)) == values.tolist()
+
+def test_integers_to_new_range_matches_list_path(tmp_path):
+    values = np.random.default_rng(1).integers(-500, 3000, 2000).tolist()
+    path = tmp_path / "input.txt"
+    path.write_text("\n".join(map(str, values)), encoding="utf-8")
+    assert integer_file_range(str(path)) == (min(values), max(values))
+    expected = lov_to_new_range(values, min(values), max(values), 0, 6)
+    for chunk_bytes in (3, 100, INTEGER_CHUNK_BYTES):
+        for bounds in (None, (min(values), max(values))):
+            chunks = iter_integers_to_new_range(str(path), 0, 6, bounds, chunk_bytes=chunk_bytes)
+            assert np.concatenate(list(chunks)).tolist() == expected
+
+    from mus_from_nums import numbers_to_notes, iter_numbers_to_notes
+    assert list(iter_numbers_to_notes(str(path), chunk_bytes=100)) == numbers_to_notes(values)
+    with pytest.raises(Exception):
+        list(iter_numbers_to_notes(str(path), bounds=(0, 100)))